@@ -32,5 +32,5 @@ from .application import (
     PublicClientApplication,
     )
 from .oauth2cli.oidc import Prompt
-from .token_cache import TokenCache, SerializableTokenCache
+from .token_cache import TokenCache, SerializableTokenCache, ShardedTokenCache
 
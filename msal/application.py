@@ -1,4 +1,6 @@
+import base64
 import functools
+import hashlib
 import json
 import time
 try:  # Python 2
@@ -7,7 +9,9 @@ except:  # Python 3
     from urllib.parse import urljoin
 import logging
 import sys
+import uuid
 import warnings
+import weakref
 from threading import Lock
 import os
 
@@ -20,6 +24,7 @@ from .wstrust_response import *
 from .token_cache import TokenCache
 import msal.telemetry
 from .region import _detect_region
+from .concurrency import _FileLease, _RefreshAheadScheduler, _SingleFlight
 from .throttled_http_client import ThrottledHttpClient
 
 
@@ -64,6 +69,47 @@ def _str2bytes(raw):
         return raw
 
 
+def _hash_user_assertion(user_assertion):
+    # The assertion itself is a credential, so only its hash is kept in cache
+    return base64.urlsafe_b64encode(
+        hashlib.sha256(_str2bytes(user_assertion)).digest()
+        ).rstrip(b"=").decode("ascii")
+
+
+def _run_refresh_ahead(app_ref, key):
+    # A refresh-ahead job holds its app weakly, so that a discarded app
+    # can still be garbage collected, rather than keep redeeming tokens.
+    app = app_ref()
+    refresh = app and app._refresh_ahead_jobs.pop(key, None)
+    if not refresh:
+        return None
+    try:
+        result = refresh()
+    except Exception:
+        app._refresh_ahead_failures[key] = time.time()  # So that retry backs off
+        raise
+    if result and "error" in result:
+        app._refresh_ahead_failures[key] = time.time()
+    else:
+        app._refresh_ahead_failures.pop(key, None)
+    return result
+
+
+class _StsUnavailable(Exception):
+    # Raised by a refresh which failed because the STS was unreachable,
+    # or because it responded with an HTTP 5xx or 429
+    def __init__(self, result=None, error=None):
+        super(_StsUnavailable, self).__init__(result or error)
+        self.result = result  # The error response, if any
+        self.error = error  # The exception raised, if any
+
+
+def _is_sts_unavailable(status_code, error=None):
+    if status_code is None:  # No response, which is typically a network error
+        return isinstance(error, (IOError, OSError))  # Including requests' errors
+    return status_code >= 500 or status_code == 429
+
+
 def _clean_up(result):
     if isinstance(result, dict):
         result.pop("refresh_in", None)  # MSAL handled refresh_in, customers need not
@@ -173,6 +219,11 @@ class ClientApplication(object):
                 # when we would eventually want to add this feature to PCA in future.
             exclude_scopes=None,
             http_cache=None,
+            refresh_ahead_workers=None,
+            refresh_lease_dir=None,
+            refresh_before_expiry=5*60,
+            refresh_jitter=0,
+            serve_stale_tokens=False,
             ):
         """Create an instance of application.
 
@@ -408,6 +459,75 @@ class ClientApplication(object):
             Personally Identifiable Information (PII). Encryption is unnecessary.
 
             New in version 1.16.0.
+
+        :param int refresh_ahead_workers:
+            Opt in to refresh access tokens in background threads,
+            shortly before they would otherwise be refreshed by a caller.
+            This is the maximal number of refreshes running concurrently.
+
+            A token is kept fresh this way as long as it is being hit in cache,
+            by :func:`~acquire_token_silent`,
+            :func:`~ConfidentialClientApplication.acquire_token_for_client`
+            or :func:`~ConfidentialClientApplication.acquire_token_on_behalf_of`.
+            So, a busy app would rarely see a cache miss on the path of a request.
+
+            The threads are stopped by :func:`~close`,
+            or when this app is garbage collected.
+            If your app creates an app object per request,
+            remember to :func:`~close` it, or use it as a context manager.
+
+            Default value is None, which means no background refresh.
+
+        :param str refresh_lease_dir:
+            A directory shared by multiple processes of your app,
+            such as the pre-forked workers of a web server,
+            which also share one persisted token cache.
+            Before refreshing a token, a process would obtain a lease
+            by creating a lock file in this directory.
+            Other processes needing the same token would wait for that refresh
+            and then re-read the token from the token cache,
+            rather than all redeeming the same refresh token.
+
+            The lease expires after 30 seconds, so a crashed process
+            won't block others for longer than that.
+            This is useful only with a token cache which reads changes
+            made by other processes, such as
+            :class:`~msal.persistence.MmapTokenCache`.
+
+            Default value is None, which means no inter-process lease.
+
+        :param int refresh_before_expiry:
+            An access token in cache is considered expired, and will be refreshed,
+            when it has fewer than this many seconds left.
+            Default value is 300 (i.e. 5 minutes).
+
+        :param int refresh_jitter:
+            Up to this many seconds, an access token will be refreshed earlier
+            than when it is considered aging (per its ``refresh_in``)
+            or expired (per ``refresh_before_expiry``).
+            The actual amount is pseudo-random per token and per app instance,
+            but remains the same for the lifetime of that instance.
+
+            When a fleet of app instances obtained their tokens at the same time,
+            such as during a deployment, this would spread their refreshes
+            across a window, rather than having them all hit the identity provider
+            in the same few seconds and then get throttled.
+            It shall be much shorter than the lifetime of an access token,
+            such as 10 minutes for a token lasting for an hour or longer.
+
+            Default value is 0, which means no jitter.
+
+        :param bool serve_stale_tokens:
+            An access token is typically accepted by resources for a while
+            after it expires, per its ``ext_expires_in``.
+            If True, when a token needs to be refreshed but the identity provider
+            is unreachable or unavailable (i.e. a network error, a HTTP 5xx or 429),
+            an expired access token within that extended lifetime will be returned,
+            with an extra ``"stale": True`` in the result,
+            and its ``expires_in`` being the rest of its extended lifetime.
+            This keeps your app available during an outage of the identity provider.
+
+            Default value is False.
         """
         self.client_id = client_id
         self.client_credential = client_credential
@@ -475,6 +595,43 @@ class ClientApplication(object):
         self.authority_groups = None
         self._telemetry_buffer = {}
         self._telemetry_lock = Lock()
+        self._refresh_ahead = _RefreshAheadScheduler(
+            workers=refresh_ahead_workers) if refresh_ahead_workers else None
+        self._refresh_ahead_jobs = {}  # {key: refresh}
+        self._refresh_ahead_failures = {}  # {key: when its last refresh failed}
+        if self._refresh_ahead:
+            self._refresh_ahead.close_with(self)
+        self._single_flight = _SingleFlight()
+        self._refresh_lease_dir = refresh_lease_dir
+        self._refresh_before_expiry = refresh_before_expiry
+        self._refresh_jitter = refresh_jitter
+        self._refresh_jitter_seed = uuid.uuid4().hex  # Differs per app instance
+        self._serve_stale_tokens = serve_stale_tokens
+
+    def close(self):
+        """Release the resources held by this app.
+
+        Currently, they are the background threads of ``refresh_ahead_workers``.
+        Refreshes already running would still finish,
+        but no more refresh would be started afterwards.
+        This app is still usable, and it would simply stop refreshing ahead.
+
+        This method is called automatically when this app is used
+        as a context manager, such as::
+
+            with msal.ConfidentialClientApplication(...) as app:
+                result = app.acquire_token_for_client(...)
+        """
+        if self._refresh_ahead:
+            self._refresh_ahead.close()  # Then it would track no more refresh
+        self._refresh_ahead_jobs.clear()
+        self._refresh_ahead_failures.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _decorate_scope(
             self, scopes,
@@ -1188,62 +1345,261 @@ class ClientApplication(object):
                 }.get(final_result["suberror"], final_result["suberror"])
         return final_result
 
-    def _acquire_token_silent_from_cache_and_possibly_refresh_it(
-            self,
-            scopes,  # type: List[str]
-            account,  # type: Optional[Account]
-            authority,  # This can be different than self.authority
-            force_refresh=False,  # type: Optional[boolean]
-            claims_challenge=None,
-            **kwargs):
-        access_token_from_cache = None
-        if not (force_refresh or claims_challenge):  # Bypass AT when desired or using claims
-            query={
-                    "client_id": self.client_id,
-                    "environment": authority.instance,
-                    "realm": authority.tenant,
-                    "home_account_id": (account or {}).get("home_account_id"),
-                    }
-            key_id = kwargs.get("data", {}).get("key_id")
-            if key_id:  # Some token types (SSH-certs, POP) are bound to a key
-                query["key_id"] = key_id
-            matches = self.token_cache.find(
+    def _coalesce(self, function, key, find_access_token=None):
+        # Concurrent callers of the returned function with the same key
+        # would share one execution, so that a token is refreshed only once
+        # and a rotated RT won't be redeemed again by a racing caller.
+        # If refresh_lease_dir is configured, callers from other processes
+        # are also coalesced, by a lease. Those who wait for the lease would
+        # use find_access_token(), if any, to see whether the lease holder
+        # has put a good AT into the (shared) token cache.
+        if self._refresh_lease_dir:
+            function = self._lease(function, key, find_access_token)
+        def coalesced(*args, **kwargs):
+            result = self._single_flight.do(key, function, *args, **kwargs)
+            return dict(result) if result else result  # Each caller gets a copy
+        return coalesced
+
+    _REFRESH_LEASE_TTL = 30  # Seconds. A refresh shall be done within this time.
+    _REFRESH_LEASE_POLL_INTERVAL = 0.1  # Seconds
+
+    def _lease(self, function, key, find_access_token=None):
+        def find_good_access_token():
+            if find_access_token:
+                access_token_from_cache, refresh_reason = find_access_token()
+                if not refresh_reason:
+                    return access_token_from_cache
+        @functools.wraps(function)
+        def leased(*args, **kwargs):
+            lease = _FileLease(
+                os.path.join(self._refresh_lease_dir, "{}.lease".format(
+                    hashlib.sha256(_str2bytes(repr(key))).hexdigest())),
+                ttl=self._REFRESH_LEASE_TTL)
+            deadline = time.time() + self._REFRESH_LEASE_TTL
+            while not lease.acquire():
+                if time.time() > deadline:  # Holder seems stuck. Go by ourselves.
+                    logger.warning("Timed out waiting for another refresh")
+                    return function(*args, **kwargs)
+                time.sleep(self._REFRESH_LEASE_POLL_INTERVAL)
+                access_token_from_cache = find_good_access_token()
+                if access_token_from_cache:
+                    logger.debug("Another process has refreshed the token")
+                    return access_token_from_cache
+            try:
+                # The previous holder may have refreshed it right before we got here
+                return find_good_access_token() or function(*args, **kwargs)
+            finally:
+                lease.release()
+        return leased
+
+    def get_coalesced_refresh_metrics(self):
+        """Returns how concurrent token refreshes were coalesced by this app.
+
+        When multiple threads need to refresh the same token at the same time,
+        only one of them goes to the network, and the others wait for its result.
+
+        :return: A dict containing these counters:
+
+            - "executed": Number of refreshes which went to the network.
+            - "coalesced": Number of refreshes which waited for another one instead.
+            - "wait_seconds": Total time spent by the coalesced refreshes.
+            - "max_wait_seconds": Longest time spent by a coalesced refresh.
+        """
+        return self._single_flight.get_metrics()
+
+    _REFRESH_AHEAD_LEAD = 60  # Seconds to refresh ahead of a foreground refresh
+    _REFRESH_AHEAD_BACKOFF = 15  # Seconds to wait before retrying a failed one
+
+    def _get_refresh_jitter(self, entry):
+        # Deterministic per token and per app instance, in [0, refresh_jitter)
+        if not self._refresh_jitter:
+            return 0
+        digest = hashlib.sha256(_str2bytes(self._refresh_jitter_seed + "-".join([
+            self.token_cache.key_makers[
+                self.token_cache.CredentialType.ACCESS_TOKEN](**entry),
+            entry.get("key_id") or "",
+            ]))).hexdigest()
+        return self._refresh_jitter * int(digest[:8], 16) / float(0x100000000)
+
+    def _get_refresh_times(self, entry):
+        # Returns (aging_on, expiring_on) of an AT, both being jittered.
+        # An AT shall be refreshed after aging_on, and not be used after expiring_on.
+        jitter = self._get_refresh_jitter(entry)
+        expiring_on = int(entry["expires_on"]) - self._refresh_before_expiry - jitter
+        if "refresh_on" in entry:
+            return min(int(entry["refresh_on"]) - jitter, expiring_on), expiring_on
+        return expiring_on, expiring_on
+
+    def _find_access_token_in_cache(self, scopes, query, key_id=None, refresh=None):
+        # Returns (access_token_from_cache, refresh_reason).
+        # A None refresh_reason means the AT found is still good as new.
+        # The refresh callable, if any, would be scheduled to renew the AT found.
+        if key_id:  # Some token types (SSH-certs, POP) are bound to a key
+            query = dict(query, key_id=key_id)
+        matches = self.token_cache.find(
+            self.token_cache.CredentialType.ACCESS_TOKEN,
+            target=scopes,
+            query=query)
+        now = time.time()
+        refresh_reason = msal.telemetry.AT_ABSENT
+        for entry in matches:
+            aging_on, expiring_on = self._get_refresh_times(entry)
+            if expiring_on < now:  # Then consider it expired
+                refresh_reason = msal.telemetry.AT_EXPIRED
+                continue  # Removal is not necessary, it will be overwritten
+            logger.debug("Cache hit an AT")
+            access_token_from_cache = {  # Mimic a real response
+                "access_token": entry["secret"],
+                "token_type": entry.get("token_type", "Bearer"),
+                "expires_in": int(int(entry["expires_on"]) - now),  # OAuth2 specs defines it as int
+                }
+            if aging_on < now:
+                # With a fallback in hand, we stop here to go refresh
+                return access_token_from_cache, msal.telemetry.AT_AGING
+            self._build_telemetry_context(-1).hit_an_access_token()
+            if refresh and self._refresh_ahead:
+                key = (self.token_cache.key_makers[
+                    self.token_cache.CredentialType.ACCESS_TOKEN](**entry), key_id)
+                due = aging_on - self._REFRESH_AHEAD_LEAD
+                failed_at = self._refresh_ahead_failures.get(key)
+                if failed_at:  # Back off, rather than retry on every hit
+                    due = max(due, failed_at + self._REFRESH_AHEAD_BACKOFF)
+                self._refresh_ahead_jobs[key] = refresh
+                if not self._refresh_ahead.track(
+                        key,
+                        functools.partial(_run_refresh_ahead, weakref.ref(self), key),
+                        due):
+                    self._refresh_ahead_jobs.pop(key, None)  # E.g. app closed
+            return access_token_from_cache, None
+        return None, refresh_reason
+
+    def _find_stale_access_token_in_cache(self, scopes, query, key_id=None):
+        # Returns an AT which is considered expired but still in its extended lifetime
+        if key_id:
+            query = dict(query, key_id=key_id)
+        now = time.time()
+        for entry in self.token_cache.find(
                 self.token_cache.CredentialType.ACCESS_TOKEN,
                 target=scopes,
-                query=query)
-            now = time.time()
-            refresh_reason = msal.telemetry.AT_ABSENT
-            for entry in matches:
-                expires_in = int(entry["expires_on"]) - now
-                if expires_in < 5*60:  # Then consider it expired
-                    refresh_reason = msal.telemetry.AT_EXPIRED
-                    continue  # Removal is not necessary, it will be overwritten
-                logger.debug("Cache hit an AT")
-                access_token_from_cache = {  # Mimic a real response
+                query=query):
+            extended_expires_in = int(entry.get("extended_expires_on", 0)) - now
+            if extended_expires_in > 0:
+                logger.warning("Serving a stale AT, because the STS is unavailable")
+                return {  # Mimic a real response
                     "access_token": entry["secret"],
                     "token_type": entry.get("token_type", "Bearer"),
-                    "expires_in": int(expires_in),  # OAuth2 specs defines it as int
+                    "expires_in": int(extended_expires_in),
+                    "stale": True,
                     }
-                if "refresh_on" in entry and int(entry["refresh_on"]) < now:  # aging
-                    refresh_reason = msal.telemetry.AT_AGING
-                    break  # With a fallback in hand, we break here to go refresh
-                self._build_telemetry_context(-1).hit_an_access_token()
+
+    def _find_fallback(self, access_token_from_cache, find_stale_access_token):
+        # Returns an AT to be served when the STS is unavailable, or None
+        if access_token_from_cache:  # The aging AT is still usable
+            return access_token_from_cache
+        if self._serve_stale_tokens and find_stale_access_token:
+            return find_stale_access_token()
+
+    def _refresh_or_report_outage(self, refresh, post=None, **kwargs):
+        # Returns refresh(**kwargs), whose HTTP responses are observed.
+        # A failure due to an unavailable STS is raised as _StsUnavailable,
+        # so that callers coalesced with this refresh would all know it.
+        status_codes = []
+        def observed_post(*args, **kwargs):
+            status_codes.append(None)  # Until a response arrives
+            response = (post or self.http_client.post)(*args, **kwargs)
+            status_codes[-1] = response.status_code
+            return response
+        try:
+            result = refresh(post=observed_post, **kwargs)
+        except Exception as e:
+            if status_codes and _is_sts_unavailable(status_codes[-1], error=e):
+                raise _StsUnavailable(error=e)
+            raise
+        if result and "error" in result and status_codes and _is_sts_unavailable(
+                status_codes[-1]):
+            raise _StsUnavailable(result=result)
+        return result
+
+    def _acquire_token_from_cache_or_by_refresh(
+            self, scopes, query, refresh, coalescing_key,
+            key_id=None, force_refresh=False, claims_challenge=None, post=None):
+        # The common flow of all the methods which serve tokens from cache:
+        # a good AT in cache is returned as-is; otherwise refresh() is called,
+        # coalesced by coalescing_key, and a failed refresh would fall back to
+        # an aging AT, or to a stale AT if serve_stale_tokens is enabled
+        # and the STS is unavailable.
+        # refresh(refresh_reason=..., post=...) shall return a response,
+        # or None when it has nothing to refresh with.
+        access_token_from_cache = find_stale_access_token = None
+        use_cache = not (force_refresh or claims_challenge)  # Bypass AT when desired or using claims
+        find_access_token = functools.partial(
+            self._find_access_token_in_cache, scopes, query, key_id)
+        refresh = self._coalesce(
+            functools.partial(self._refresh_or_report_outage, refresh, post=post),
+            # A forced refresh shall not share the outcome of an unforced one
+            (getattr(refresh, "func", refresh).__name__, force_refresh
+                ) + coalescing_key,
+            find_access_token=find_access_token if use_cache else None)
+        if use_cache:
+            access_token_from_cache, refresh_reason = find_access_token(
+                refresh=functools.partial(
+                    refresh, refresh_reason=msal.telemetry.AT_AGING))
+            if not refresh_reason:
                 return access_token_from_cache  # It is still good as new
+            find_stale_access_token = functools.partial(
+                self._find_stale_access_token_in_cache, scopes, query, key_id)
         else:
             refresh_reason = msal.telemetry.FORCE_REFRESH  # TODO: It could also mean claims_challenge
-        assert refresh_reason, "It should have been established at this point"
         try:
-            result = _clean_up(self._acquire_token_silent_by_finding_rt_belongs_to_me_or_my_family(
-                authority, self._decorate_scope(scopes), account,
-                refresh_reason=refresh_reason, claims_challenge=claims_challenge,
-                **kwargs))
-            if (result and "error" not in result) or (not access_token_from_cache):
-                return result
+            result = _clean_up(refresh(refresh_reason=refresh_reason))
+        except _StsUnavailable as e:  # Potential AAD outage
+            outage = e
         except:  # The exact HTTP exception is transportation-layer dependent
-            # Typically network error. Potential AAD outage?
             if not access_token_from_cache:  # It means there is no fall back option
                 raise  # We choose to bubble up the exception
-        return access_token_from_cache
+            return access_token_from_cache
+        else:
+            if result and "error" not in result:
+                return result
+            return access_token_from_cache or result
+        fallback = self._find_fallback(
+            access_token_from_cache, find_stale_access_token)
+        if fallback:
+            return fallback
+        if outage.error is not None:
+            raise outage.error  # Bubble up the original exception
+        return _clean_up(dict(outage.result))  # Each caller gets a copy
+
+    def _acquire_token_silent_from_cache_and_possibly_refresh_it(
+            self,
+            scopes,  # type: List[str]
+            account,  # type: Optional[Account]
+            authority,  # This can be different than self.authority
+            force_refresh=False,  # type: Optional[boolean]
+            claims_challenge=None,
+            **kwargs):
+        post = kwargs.pop("post", None)  # Its HTTP statuses will be observed
+        return self._acquire_token_from_cache_or_by_refresh(
+            scopes,
+            {
+                "client_id": self.client_id,
+                "environment": authority.instance,
+                "realm": authority.tenant,
+                "home_account_id": (account or {}).get("home_account_id"),
+                },
+            functools.partial(
+                self._acquire_token_silent_by_finding_rt_belongs_to_me_or_my_family,
+                authority, self._decorate_scope(scopes), account,
+                claims_challenge=claims_challenge, **kwargs),
+            (
+                authority.instance, authority.tenant,
+                (account or {}).get("home_account_id"), tuple(sorted(scopes)),
+                claims_challenge, repr(sorted(kwargs.get("data", {}).items())),
+                ),
+            key_id=kwargs.get("data", {}).get("key_id"),
+            force_refresh=force_refresh,
+            claims_challenge=claims_challenge,
+            post=post)
 
     def _acquire_token_silent_by_finding_rt_belongs_to_me_or_my_family(
             self, authority, scopes, account, **kwargs):
@@ -1293,6 +1649,7 @@ class ClientApplication(object):
             self, authority, scopes, query,
             rt_remover=None, break_condition=lambda response: False,
             refresh_reason=None, correlation_id=None, claims_challenge=None,
+            user_assertion_hash=None,  # Needed when refreshing an OBO RT
             **kwargs):
         matches = self.token_cache.find(
             self.token_cache.CredentialType.REFRESH_TOKEN,
@@ -1328,6 +1685,7 @@ class ClientApplication(object):
                     event,
                     environment=authority.instance,
                     skip_account_creation=True,  # To honor a concurrent remove_account()
+                    user_assertion_hash=user_assertion_hash,
                     )),
                 scope=scopes,
                 headers=headers,
@@ -1658,9 +2016,18 @@ class PublicClientApplication(ClientApplication):  # browser app or mobile app
 
 class ConfidentialClientApplication(ClientApplication):  # server-side web app
 
-    def acquire_token_for_client(self, scopes, claims_challenge=None, **kwargs):
+    def acquire_token_for_client(
+            self, scopes, claims_challenge=None, force_refresh=False, **kwargs):
         """Acquires token for the current confidential client, not for an end user.
 
+        A valid access token previously obtained for the same scopes
+        will be returned from the token cache, without a network round-trip.
+        A token is not considered valid once it is within
+        ``refresh_before_expiry`` seconds of its expiry
+        (or slightly earlier, per ``refresh_jitter``).
+        A token which the server suggested to be refreshed (via ``refresh_in``)
+        will be refreshed, and still be returned if that refresh fails.
+
         :param list[str] scopes: (Required)
             Scopes requested to access a protected API (a resource).
         :param claims_challenge:
@@ -1668,21 +2035,46 @@ class ConfidentialClientApplication(ClientApplication):  # server-side web app
             in the form of a claims_challenge directive in the www-authenticate header to be
             returned from the UserInfo Endpoint and/or in the ID Token and/or Access Token.
             It is a string of a JSON object which contains lists of claims being requested from these locations.
+            A claims_challenge also bypasses the token cache.
+        :param force_refresh:
+            If True, it will skip the token cache and always obtain a new token.
 
         :return: A dict representing the json response from AAD:
 
             - A successful response would contain "access_token" key,
             - an error response would contain "error" and usually "error_description".
         """
-        # TBD: force_refresh behavior
         if self.authority.tenant.lower() in ["common", "organizations"]:
             warnings.warn(
                 "Using /common or /organizations authority "
                 "in acquire_token_for_client() is unreliable. "
                 "Please use a specific tenant instead.", DeprecationWarning)
         self._validate_ssh_cert_input_data(kwargs.get("data", {}))
+        post = kwargs.pop("post", None)  # Its HTTP statuses will be observed
+        return self._acquire_token_from_cache_or_by_refresh(
+            scopes,
+            {
+                "client_id": self.client_id,
+                "environment": self.authority.instance,
+                "realm": self.authority.tenant,
+                "home_account_id": None,  # App-only tokens belong to no user
+                },
+            functools.partial(
+                self._acquire_token_for_client,
+                scopes, claims_challenge=claims_challenge, **kwargs),
+            (
+                self.authority.instance, self.authority.tenant, tuple(sorted(scopes)),
+                claims_challenge, repr(sorted(kwargs.get("data", {}).items())),
+                ),
+            key_id=kwargs.get("data", {}).get("key_id"),
+            force_refresh=force_refresh,
+            claims_challenge=claims_challenge,
+            post=post)
+
+    def _acquire_token_for_client(
+            self, scopes, refresh_reason, claims_challenge=None, **kwargs):
         telemetry_context = self._build_telemetry_context(
-            self.ACQUIRE_TOKEN_FOR_CLIENT_ID)
+            self.ACQUIRE_TOKEN_FOR_CLIENT_ID, refresh_reason=refresh_reason)
         client = self._regional_client or self.client
         response = _clean_up(client.obtain_token_for_client(
             scope=scopes,  # This grant flow requires no scope decoration
@@ -1695,7 +2087,9 @@ class ConfidentialClientApplication(ClientApplication):  # server-side web app
         telemetry_context.update_telemetry(response)
         return response
 
-    def acquire_token_on_behalf_of(self, user_assertion, scopes, claims_challenge=None, **kwargs):
+    def acquire_token_on_behalf_of(
+            self, user_assertion, scopes, claims_challenge=None, force_refresh=False,
+            **kwargs):
         """Acquires token using on-behalf-of (OBO) flow.
 
         The current app is a middle-tier service which was called with a token
@@ -1708,6 +2102,12 @@ class ConfidentialClientApplication(ClientApplication):  # server-side web app
         See how to gain consent upfront for your middle-tier app from this article.
         https://docs.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow#gaining-consent-for-the-middle-tier-application
 
+        Tokens obtained are cached under a hash of the user assertion.
+        Subsequent calls with the same user assertion and scopes
+        will be served by a cached access token, or by the cached refresh token
+        when the access token has expired,
+        rather than redeeming the same user assertion again.
+
         :param str user_assertion: The incoming token already received by this app
         :param list[str] scopes: Scopes required by downstream API (a resource).
         :param claims_challenge:
@@ -1715,14 +2115,57 @@ class ConfidentialClientApplication(ClientApplication):  # server-side web app
             in the form of a claims_challenge directive in the www-authenticate header to be
             returned from the UserInfo Endpoint and/or in the ID Token and/or Access Token.
             It is a string of a JSON object which contains lists of claims being requested from these locations.
+            A claims_challenge also bypasses the token cache.
+        :param force_refresh:
+            If True, it will skip the token cache and always redeem the user assertion.
 
         :return: A dict representing the json response from AAD:
 
             - A successful response would contain "access_token" key,
             - an error response would contain "error" and usually "error_description".
         """
+        user_assertion_hash = _hash_user_assertion(user_assertion)
+        query = {
+            "client_id": self.client_id,
+            "environment": self.authority.instance,
+            "user_assertion_hash": user_assertion_hash,
+            }
+        post = kwargs.pop("post", None)  # Its HTTP statuses will be observed
+        return self._acquire_token_from_cache_or_by_refresh(
+            scopes,
+            dict(query, realm=self.authority.tenant),
+            functools.partial(
+                self._acquire_token_on_behalf_of,
+                user_assertion, user_assertion_hash, scopes, query,
+                claims_challenge=claims_challenge, **kwargs),
+            (
+                self.authority.instance, user_assertion_hash, tuple(sorted(scopes)),
+                claims_challenge, repr(sorted(kwargs.get("data", {}).items())),
+                ),
+            key_id=kwargs.get("data", {}).get("key_id"),
+            force_refresh=force_refresh,
+            claims_challenge=claims_challenge,
+            post=post)
+
+    def _acquire_token_on_behalf_of(
+            self, user_assertion, user_assertion_hash, scopes, query,
+            refresh_reason, claims_challenge=None, **kwargs):
+        if refresh_reason != msal.telemetry.FORCE_REFRESH:
+            # The OBO RT is preferred, so that the user assertion,
+            # which may have expired, need not be redeemed again
+            try:
+                result = _clean_up(
+                    self._acquire_token_silent_by_finding_specific_refresh_token(
+                        self.authority, self._decorate_scope(scopes), query,
+                        refresh_reason=refresh_reason,
+                        user_assertion_hash=user_assertion_hash, **kwargs))
+                if result and "error" not in result:
+                    return result
+            except:  # The exact HTTP exception is transportation-layer dependent
+                logger.debug("Unable to refresh by the OBO RT", exc_info=True)
+            # Otherwise the user assertion could still be redeemed below
         telemetry_context = self._build_telemetry_context(
-            self.ACQUIRE_TOKEN_ON_BEHALF_OF_ID)
+            self.ACQUIRE_TOKEN_ON_BEHALF_OF_ID, refresh_reason=refresh_reason)
         # The implementation is NOT based on Token Exchange
         # https://tools.ietf.org/html/draft-ietf-oauth-token-exchange-16
         response = _clean_up(self.client.obtain_token_by_assertion(  # bases on assertion RFC 7521
@@ -1741,6 +2184,11 @@ class ConfidentialClientApplication(ClientApplication):  # server-side web app
                     self._client_capabilities, claims_challenge)),
             headers=telemetry_context.generate_headers(),
                 # TBD: Expose a login_hint (or ccs_routing_hint) param for web app
+            on_obtaining_tokens=lambda event: self.token_cache.add(dict(
+                event,
+                environment=self.authority.instance,
+                user_assertion_hash=user_assertion_hash,
+                )),
             **kwargs))
         telemetry_context.update_telemetry(response)
         return response
@@ -0,0 +1,289 @@
+import errno
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+
+try:
+    import queue
+except ImportError:  # Fall back to Python 2
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class _PublishingLock(object):
+    """A reentrant lock which calls publish() right before its outermost release.
+
+    A copy-on-write structure guarded by this lock would publish
+    the changes of a write as a whole, however deeply the write is nested.
+    publish() runs while the lock is still held.
+    """
+    def __init__(self, publish):
+        self._lock = threading.RLock()
+        self._publish = publish
+        self._owner = None  # The thread currently holding the lock
+        self._depth = 0
+
+    def acquire(self):
+        self._lock.acquire()
+        self._owner = threading.current_thread()
+        self._depth += 1
+        return True
+
+    def release(self):
+        if not self.is_held():
+            raise RuntimeError("Cannot release an un-acquired lock")
+        try:
+            if self._depth == 1:
+                self._publish()
+        finally:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+            self._lock.release()
+
+    def is_held(self):
+        """Returns whether the current thread holds this lock."""
+        return self._owner is threading.current_thread()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _RefreshAheadScheduler(object):
+    """Runs each tracked refresh at its due time, in a bounded pool of threads.
+
+    Only tokens being used are kept fresh.
+    A refresh is tracked when a caller hits a token in cache,
+    and it is forgotten after it ran,
+    until a caller hits the renewed token and thus tracks it again.
+    An idle token would therefore be refreshed at most once.
+    """
+    def __init__(self, workers=1, timer=time.time):
+        """Create a scheduler. Its threads are started on first use.
+
+        :param int workers: Maximal number of refreshes running concurrently.
+        :param timer: A function returning current time in seconds.
+        """
+        if workers < 1:
+            raise ValueError("There shall be at least 1 worker")
+        self._workers = workers
+        self._timer = timer
+        self._condition = threading.Condition()
+        self._due = []  # A heap of (due, sequence, key)
+        self._sequence = itertools.count()  # It breaks the tie of identical due
+        self._jobs = {}  # {key: (due, refresh)}
+        self._running = set()  # Keys being refreshed
+        self._queue = queue.Queue()
+        self._threads = []
+        self._closed = False
+        self._owner = None
+
+    def track(self, key, refresh, due):
+        """Schedule a refresh, replacing the previous one of the same key.
+
+        :param key: A hashable identity of the token, such as its cache key.
+        :param refresh: A callable which renews the token into the token cache.
+        :param float due: When the refresh shall run, in seconds since epoch.
+        :return: False if it is not tracked, because this scheduler is closed,
+            or because the same key is being refreshed. Otherwise True.
+        """
+        with self._condition:
+            if self._closed or key in self._running:
+                return False
+            scheduled = self._jobs.get(key)
+            self._jobs[key] = (due, refresh)
+            if scheduled and scheduled[0] == due:
+                return True  # The token was hit again before its refresh. No-op.
+            heapq.heappush(self._due, (due, next(self._sequence), key))
+            if not self._threads:
+                self._start()
+            self._condition.notify()
+            return True
+
+    def _start(self):
+        self._threads.append(threading.Thread(target=self._dispatch))
+        self._threads.extend(
+            threading.Thread(target=self._work) for _ in range(self._workers))
+        for thread in self._threads:
+            thread.daemon = True  # It shall not block the exit of an app
+            thread.start()
+
+    def _dispatch(self):
+        with self._condition:
+            while not self._closed:
+                now = self._timer()
+                while self._due and self._due[0][0] <= now:
+                    due, _, key = heapq.heappop(self._due)
+                    job = self._jobs.get(key)
+                    if job is None or job[0] != due:
+                        continue  # It has been rescheduled
+                    del self._jobs[key]
+                    self._running.add(key)
+                    self._queue.put((key, job[1]))
+                self._condition.wait(
+                    self._due[0][0] - now if self._due else None)
+
+    def _work(self):
+        for key, refresh in iter(self._queue.get, None):
+            try:
+                result = refresh()
+                if result and "error" in result:
+                    logger.warning(
+                        "Refresh-ahead failed: %s", result.get("error"))
+                else:
+                    logger.debug("Refresh-ahead succeeded")
+            except Exception:  # The exact HTTP exception is transportation-layer dependent
+                logger.exception("Refresh-ahead failed")
+            finally:
+                refresh = None  # Do not hold it while waiting for the next one
+                with self._condition:
+                    self._running.discard(key)
+
+    def close(self, wait=True):
+        """Stop the threads. Refreshes already due would still finish.
+
+        :param bool wait: Whether to wait for the threads to stop.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._jobs.clear()
+            self._condition.notify()
+        for _ in range(self._workers):
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def close_with(self, owner):
+        """Close this scheduler, without waiting, once owner is garbage collected.
+
+        Only a weak reference of the owner is held, so its tracked refreshes
+        shall also hold it weakly, otherwise it would never be collected.
+        """
+        self._owner = weakref.ref(owner, lambda ref: self.close(wait=False))
+
+
+class _Flight(object):
+    def __init__(self):
+        self.landed = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight(object):
+    """Coalesces concurrent calls of the same key into one execution.
+
+    The first caller of a key runs the function.
+    Callers arriving while it is running wait for, and share, its outcome,
+    which is either its return value or its exception.
+    A call arriving afterwards would run the function again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # {key: _Flight}
+        self._metrics = {
+            "executed": 0,  # Calls which ran the function
+            "coalesced": 0,  # Calls which waited for another call instead
+            "wait_seconds": 0.0,  # Total time spent by the coalesced calls
+            "max_wait_seconds": 0.0,
+            }
+
+    def do(self, key, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), or the outcome of an identical call
+        already in flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._metrics["executed"] += 1
+        if not leader:
+            started = time.time()
+            flight.landed.wait()
+            waited = time.time() - started
+            with self._lock:
+                self._metrics["coalesced"] += 1
+                self._metrics["wait_seconds"] += waited
+                self._metrics["max_wait_seconds"] = max(
+                    waited, self._metrics["max_wait_seconds"])
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.landed.set()
+
+    def get_metrics(self):
+        """Returns a snapshot of counters, as a dict."""
+        with self._lock:
+            return dict(self._metrics)
+
+
+class _FileLease(object):
+    """An inter-process lease, held by whoever has exclusively created its file.
+
+    The lease expires ``ttl`` seconds after being obtained,
+    so that a crashed holder won't block others forever.
+    The work done while holding it shall therefore finish within ``ttl``.
+    Breaking an expired lease is best-effort,
+    so two processes may rarely believe they both hold it.
+    """
+    def __init__(self, path, ttl=30):
+        self._path = path
+        self._ttl = ttl
+        self._token = None  # It proves that the file is created by us
+
+    def acquire(self):
+        """Returns True if the lease is obtained, or False if it is held by others."""
+        for _ in range(2):  # A second attempt follows the breaking of an expired lease
+            try:
+                descriptor = os.open(
+                    self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    if time.time() - os.path.getmtime(self._path) < self._ttl:
+                        return False
+                    logger.debug("Break an expired lease %s", self._path)
+                    os.remove(self._path)
+                except OSError:  # It was released or broken by others meanwhile
+                    pass
+                continue
+            token = uuid.uuid4().hex
+            with os.fdopen(descriptor, "w") as lease_file:
+                lease_file.write(token)
+            self._token = token
+            return True
+        return False
+
+    def release(self):
+        """Release the lease, unless it has expired and been taken by others."""
+        try:
+            with open(self._path) as lease_file:
+                ours = lease_file.read() == self._token
+            if ours:  # Windows can't remove an opened file, so we removes it here
+                os.remove(self._path)
+        except (IOError, OSError):  # Already broken by others
+            pass
+        self._token = None
@@ -0,0 +1,238 @@
+"""A token cache whose entries live in a pluggable key-value store.
+
+Entries are grouped into partitions, one per end user (by home_account_id),
+plus one per realm for app-only tokens, and one for app metadata.
+Within a partition, each entry is keyed by its credential type
+and the output of :attr:`TokenCache.key_makers`.
+A look-up only fetches the partition it needs, so a store shared by a fleet
+of processes does not need to transfer or deserialize the entire cache.
+"""
+import json
+import logging
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:  # Fall back to Python 2
+    import SocketServer as socketserver
+
+from .token_cache import TokenCache, _get_partition, _route, is_subdict_of
+
+
+logger = logging.getLogger(__name__)
+
+
+def _partition_name(partition):  # ("realm", None) becomes "realm:"
+    field, value = partition
+    return u"{}:{}".format(field, value or "")
+
+
+class KeyValueStore(object):
+    """The interface of a store used by :class:`KeyValueTokenCache`.
+
+    Entries are JSON-serializable dicts.
+    Partitions, credential types and keys are all strings.
+    Implementations shall be thread-safe.
+    """
+    def get(self, partition, credential_type, key):
+        """Returns the entry, or None if it does not exist."""
+        raise NotImplementedError()
+
+    def put(self, partition, credential_type, key, entry):
+        raise NotImplementedError()
+
+    def delete(self, partition, credential_type, key):
+        """Delete the entry. Deleting a non-existent entry is a no-op."""
+        raise NotImplementedError()
+
+    def scan(self, partition, credential_type):
+        """Returns all entries of a credential type in a partition, as a dict.
+
+        It would be ``{key: entry}`` in insertion order, or ``{}`` if none.
+        """
+        raise NotImplementedError()
+
+    def partitions(self):
+        """Returns the names of all non-empty partitions."""
+        raise NotImplementedError()
+
+
+class InMemoryStore(KeyValueStore):
+    """A reference implementation of :class:`KeyValueStore`."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # {partition: {credential_type: {key: entry}}}
+
+    def get(self, partition, credential_type, key):
+        with self._lock:
+            entry = self._data.get(partition, {}).get(credential_type, {}).get(key)
+            return dict(entry) if entry is not None else None
+
+    def put(self, partition, credential_type, key, entry):
+        with self._lock:
+            self._data.setdefault(partition, {}).setdefault(
+                credential_type, {})[key] = dict(entry)
+
+    def delete(self, partition, credential_type, key):
+        with self._lock:
+            types = self._data.get(partition, {})
+            types.get(credential_type, {}).pop(key, None)
+            if not types.get(credential_type, True):
+                del types[credential_type]
+            if not types:
+                self._data.pop(partition, None)
+
+    def scan(self, partition, credential_type):
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._data.get(
+                partition, {}).get(credential_type, {}).items()}
+
+    def partitions(self):
+        with self._lock:
+            return list(self._data)
+
+
+class _StoreRequestHandler(socketserver.StreamRequestHandler):
+    # Each request is a line of {"method": ..., "params": [...]},
+    # and each response is a line of {"result": ...} or {"error": ...}.
+    def handle(self):
+        for line in iter(self.rfile.readline, b""):
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if request["method"] not in (
+                        "get", "put", "delete", "scan", "partitions"):
+                    raise ValueError("Unknown method")
+                response = {"result": getattr(self.server.store, request["method"])(
+                    *request.get("params", []))}
+            except Exception as e:
+                response = {"error": repr(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _StoreServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_store(store, host="127.0.0.1", port=0):
+    """Serve a :class:`KeyValueStore` on a local socket, in a background thread.
+
+    It is a stand-in of a remote store, so that :class:`SocketStore`
+    and a fleet sharing one store can be tested offline.
+    It has no authentication, so do not expose it beyond localhost.
+
+    :return:
+        A server, whose ``server_address`` is to be used by :class:`SocketStore`,
+        and whose ``shutdown()`` stops it.
+    """
+    server = _StoreServer((host, port), _StoreRequestHandler)
+    server.store = store
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class SocketStore(KeyValueStore):
+    """A :class:`KeyValueStore` client talking to a server from :func:`serve_store`.
+
+    Each thread uses its own connection.
+    """
+    def __init__(self, address, timeout=10):
+        self._address = tuple(address)
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def _call(self, method, *params):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = socket.create_connection(self._address, self._timeout)
+            self._local.connection = connection
+            self._local.reader = connection.makefile("rb")
+        try:
+            connection.sendall(json.dumps(
+                {"method": method, "params": params}).encode("utf-8") + b"\n")
+            line = self._local.reader.readline()
+            if not line:
+                raise IOError("Connection closed by the store")
+        except (IOError, OSError):
+            self._local.connection = None  # Reconnect next time
+            connection.close()
+            raise
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise RuntimeError("Store failed: {}".format(response["error"]))
+        return response["result"]
+
+    def get(self, partition, credential_type, key):
+        return self._call("get", partition, credential_type, key)
+
+    def put(self, partition, credential_type, key, entry):
+        self._call("put", partition, credential_type, key, entry)
+
+    def delete(self, partition, credential_type, key):
+        self._call("delete", partition, credential_type, key)
+
+    def scan(self, partition, credential_type):
+        return self._call("scan", partition, credential_type)
+
+    def partitions(self):
+        return self._call("partitions")
+
+
+class KeyValueTokenCache(TokenCache):
+    """A token cache whose entries are kept in a :class:`KeyValueStore`.
+
+    A query specifying a home_account_id only scans that user's partition.
+    A query without it (such as ``get_accounts()``) still visits all partitions.
+    Capacity of :class:`TokenCache` is not applicable here,
+    and :func:`compact` is a no-op.
+    """
+    def __init__(self, store):
+        """Create a token cache backed by a store.
+
+        :param store: A :class:`KeyValueStore`, such as :class:`InMemoryStore`.
+        """
+        super(KeyValueTokenCache, self).__init__()
+        self._store = store
+
+    def find(self, credential_type, target=None, query=None):
+        target = target or []
+        assert isinstance(target, list), "Invalid parameter type"
+        query = query or {}
+        partition = _route(credential_type, query)
+        partitions = [_partition_name(partition)] if partition is not None else (
+            self._store.partitions())
+        target_set = set(target)
+        return [entry
+            for name in partitions
+            for entry in self._store.scan(name, credential_type).values()
+            if is_subdict_of(query, entry) and (
+                target_set <= set((entry.get("target") or "").split())
+                if target else True)]
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        # Returns whether the store was actually changed
+        key = self.key_makers[credential_type](**old_entry)
+        partition = _partition_name(_get_partition(old_entry))
+        entry = dict(old_entry, **new_key_value_pairs) if new_key_value_pairs else None
+        with self._lock:  # Only serializes writers within this process
+            existing = self._store.get(partition, credential_type, key)
+            if entry == existing:  # Skip an identical rewrite, or a no-op removal
+                return False
+            if entry is not None:
+                self._store.put(partition, credential_type, key, entry)
+            else:
+                self._store.delete(partition, credential_type, key)
+            self._notify(credential_type, key, existing, entry)
+            return True
+
+    def compact(self, now=None):
+        """This is a no-op, which always returns 0.
+
+        Locating expired entries would scan every partition of the store.
+        Use the expiration mechanism of your store, if it has one, instead.
+        """
+        return 0
@@ -0,0 +1,326 @@
+"""Persistence of a token cache, so that it survives restarts or is shared by processes.
+"""
+import atexit
+from contextlib import contextmanager
+import errno
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from .token_cache import SerializableTokenCache
+
+
+logger = logging.getLogger(__name__)
+
+
+def _write_atomically(path, chunks, precondition=None):
+    # Readers would see either the old file or the new one, never a partial one.
+    # Returns False if the precondition, checked right before the swap, is unmet.
+    folder = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix=".msal_")
+    try:
+        with os.fdopen(descriptor, "wb") as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if precondition and not precondition():
+            os.remove(temp_path)
+            return False
+        # os.rename() is atomic on POSIX, but fails on Windows if path exists
+        getattr(os, "replace", os.rename)(temp_path, path)  # Py2 lacks replace()
+        return True
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def _read(path):  # Returns the content of a file, or None if it does not exist
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+@contextmanager
+def _file_lock(path):
+    # Holds an exclusive lock of the file at path, where fcntl is available.
+    # Otherwise it is a no-op.
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def save_with_merge(cache, path, retries=3):
+    """Save a versioned :class:`~msal.SerializableTokenCache` into a file,
+    which is shared by processes each doing so, without losing their updates.
+
+    If the file has been rewritten since this cache last loaded or saved it,
+    it will be re-read and merged into this cache before being overwritten.
+    See :func:`~msal.SerializableTokenCache.merge`.
+
+    The read, merge and write are done while holding an exclusive ``fcntl``
+    advisory lock on a companion ``<path>.lock`` file,
+    so processes saving this way won't overwrite each other.
+    ``fcntl`` is unavailable on Windows, where this falls back to an
+    optimistic approach: if the file moves again while we write,
+    this will retry. That only narrows the window
+    in which two processes could still overwrite each other.
+
+    :param cache:
+        A :class:`~msal.SerializableTokenCache` created with ``versioned=True``.
+    :return: True if saved or there was nothing to save, False if out of retries.
+    """
+    if not cache._versioned:
+        raise ValueError("The cache needs to be created with versioned=True")
+    for attempt in range(retries + 1):
+        # Other threads' changes shall wait till we finish
+        with cache._lock, _file_lock(path + ".lock"):
+            state = _read(path)
+            seen = cache.get_version(state)
+            if state is not None and seen != cache.version:
+                logger.debug("Merge %s, version %d -> %d", path, cache.version, seen)
+                cache.merge(state)
+            if not cache.has_state_changed:
+                return True
+            version = cache._next_version()
+            if _write_atomically(
+                    path,
+                    [cache._dump(cache.Format.JSON, version).encode("utf-8")],
+                    precondition=lambda: cache.get_version(_read(path)) == seen):
+                cache._checkpoint(version)
+                return True
+        logger.debug("%s was rewritten by others during attempt %d", path, attempt)
+    return False
+
+
+class MmapTokenCache(SerializableTokenCache):
+    """A token cache persisted in a file shared by processes on the same host,
+    such as the workers of a gunicorn or uwsgi server.
+
+    A process re-reads the file only after another process has written it,
+    which is detected by a version counter in the file header.
+    The file is memory-mapped and lazily deserialized,
+    so that reading one credential type does not copy the whole file
+    into Python strings.
+
+    Each change is a read-modify-write of the whole file,
+    performed while holding an exclusive ``fcntl`` advisory lock
+    on a companion ``<path>.lock`` file.
+    The new content is written into a temporary file which then replaces
+    the cache file atomically, so readers need no lock.
+
+    This class requires ``fcntl``, which is only available on POSIX systems.
+    """
+    _HEADER = struct.Struct("<4sIQQ")  # Magic, layout, version, payload length
+    _MAGIC = b"MSTC"
+    _LAYOUT = 1
+    # A mmap offset needs to be a multiple of the allocation granularity.
+    # Padding the header to that size allows mapping only the payload,
+    # which is then usable by SerializableTokenCache.deserialize(..., lazy=True)
+    _PAYLOAD_OFFSET = mmap.ALLOCATIONGRANULARITY
+
+    def __init__(self, path, **kwargs):
+        """Create a token cache persisted in the given file.
+
+        :param str path:
+            Path to the cache file, which will be created when first written.
+            All processes sharing the cache shall use the same path.
+        """
+        if fcntl is None:
+            raise NotImplementedError(
+                "MmapTokenCache requires fcntl, which is unavailable on this platform")
+        super(MmapTokenCache, self).__init__(**kwargs)
+        self._path = path
+        self._version = 0  # A missing file is considered as version 0
+        self._mapping = None
+        self._depth = 0  # How deep we are in nested transactions
+
+    def _reload_if_changed(self):
+        try:
+            cache_file = open(self._path, "rb")
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with cache_file:
+            header = cache_file.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                raise ValueError("{} is not a token cache file".format(self._path))
+            magic, layout, version, length = self._HEADER.unpack(header)
+            if magic != self._MAGIC or layout != self._LAYOUT:
+                raise ValueError("{} is not a token cache file".format(self._path))
+            if version == self._version:  # Quick check without lock
+                return
+            with self._lock:
+                if version <= self._version:  # Another thread was faster
+                    return
+                logger.debug(
+                    "Reload %s, version %d -> %d", self._path, self._version, version)
+                mapping = mmap.mmap(  # It remains valid even after file is closed
+                    cache_file.fileno(), length, access=mmap.ACCESS_READ,
+                    offset=self._PAYLOAD_OFFSET) if length else None
+                self.deserialize(mapping, lazy=True)
+                self._mapping = mapping  # Keep it alive while being lazily loaded
+                self._version = version
+
+    def _write(self):
+        payload = self.serialize().encode("utf-8")
+        self._version += 1
+        _write_atomically(self._path, [
+            self._HEADER.pack(
+                self._MAGIC, self._LAYOUT, self._version, len(payload)),
+            b"\0" * (self._PAYLOAD_OFFSET - self._HEADER.size),
+            payload,
+            ])
+
+    @contextmanager
+    def _transaction(self):
+        # Nested usage would join the outermost transaction
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            with _file_lock(self._path + ".lock"):
+                self._depth = 1
+                try:
+                    self._reload_if_changed()  # Modify the latest state
+                    yield
+                    if self.has_state_changed:
+                        self._write()
+                finally:
+                    self._depth = 0
+
+    def find(self, credential_type, target=None, query=None):
+        if not self._depth:  # Otherwise we are already up-to-date
+            self._reload_if_changed()
+        return super(MmapTokenCache, self).find(
+            credential_type, target=target, query=query)
+
+    def compact(self, now=None):
+        with self._transaction():  # Removals would be written only once
+            return super(MmapTokenCache, self).compact(now=now)
+
+    def add(self, event, **kwargs):
+        with self._transaction():
+            super(MmapTokenCache, self).add(event, **kwargs)
+
+    def add_many(self, events, **kwargs):
+        # The file would be written only once.
+        # A failure while saving would skip that write, but the part of the
+        # batch already applied in memory may still be written by a later change.
+        with self._transaction():
+            super(MmapTokenCache, self).add_many(events, **kwargs)
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        with self._transaction():
+            return super(MmapTokenCache, self).modify(
+                credential_type, old_entry, new_key_value_pairs)
+
+
+class WriteBehindPersister(object):
+    """Persists a :class:`~msal.SerializableTokenCache` into a file,
+    in a background thread rather than on the path of each token request.
+
+    A burst of changes would be coalesced into one write,
+    which replaces the file atomically.
+    A change is written no later than ``max_delay`` seconds after it happened,
+    so a crash loses at most that many seconds of changes.
+    Pending changes are also written when the app exits normally,
+    or when :func:`~close` is called. Usage::
+
+        cache = msal.SerializableTokenCache()
+        persister = WriteBehindPersister(cache, "my_cache.json")  # Also loads it
+        app = msal.ClientApplication(..., token_cache=cache)
+    """
+    def __init__(self, cache, path, max_delay=1, merge=False):
+        """Start persisting the cache.
+
+        :param cache: A :class:`~msal.SerializableTokenCache`.
+        :param str path:
+            The file to be written.
+            If it already exists, the cache will be loaded from it first.
+        :param float max_delay:
+            How many seconds a change may wait, for more changes to be coalesced.
+        :param bool merge:
+            Set it to True when the file is shared by multiple processes.
+            Each write would then be done by :func:`save_with_merge`,
+            which requires the cache to be created with ``versioned=True``.
+        """
+        self._cache = cache
+        self._path = path
+        self._max_delay = max_delay
+        self._merge = merge
+        state = _read(path)
+        if state is not None:
+            cache.deserialize(state)
+        self._flush_lock = threading.Lock()  # Writes shall not be reordered
+        self._changed = threading.Event()
+        self._closing = threading.Event()
+        self._closed = False
+        cache.subscribe(self._on_change)
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+        atexit.register(self.close)
+
+    def _on_change(self, event):
+        self._changed.set()  # Cheap enough to be called while cache is locked
+
+    def _run(self):
+        while True:
+            self._changed.wait()
+            if self._closing.wait(self._max_delay):  # Meanwhile, changes coalesce
+                return  # close() will flush the rest
+            self._changed.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the cache into the file now, if it has changed."""
+        with self._flush_lock:
+            if not self._cache.has_state_changed:
+                return
+            try:
+                if self._merge:
+                    if not save_with_merge(self._cache, self._path):
+                        logger.warning("%s kept being rewritten", self._path)
+                        self._changed.set()  # Retry later
+                    return
+                state = self._cache.serialize()  # It resets has_state_changed
+                _write_atomically(self._path, [state.encode("utf-8")])
+            except (IOError, OSError):
+                self._cache.has_state_changed = True
+                self._changed.set()  # Retry later
+                logger.exception("Unable to persist token cache into %s", self._path)
+
+    def close(self):
+        """Stop the background thread, and write the pending changes."""
+        if self._closed:
+            return
+        self._closed = True
+        self._cache.unsubscribe(self._on_change)
+        self._closing.set()
+        self._changed.set()  # Wake up the worker, in case it is idle
+        self._worker.join()
+        self.flush()
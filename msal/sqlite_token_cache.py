@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+
+from .token_cache import TokenCache, _get_usable_until, is_subdict_of
+
+
+def _bindable(value):  # SQLite columns would only hold scalar values
+    return value is None or isinstance(value, (type(u""), str, int, float))
+
+
+class SqliteTokenCache(TokenCache):
+    """A token cache which stores each entry as a row in a SQLite database.
+
+    The fields used by ``key_makers`` and the expiry of each entry
+    are stored in indexed columns,
+    so that look-ups, updates and :func:`compact` are performed row by row.
+    The cache is neither loaded into memory nor rewritten as a whole,
+    which would otherwise be needed by :func:`SerializableTokenCache.serialize`.
+
+    Multiple processes on the same host may share one database file.
+    SQLite's own locking keeps them consistent.
+    """
+    _COLUMNS = (  # Fields of an entry, stored in their own columns for look-ups
+        "client_id", "environment", "realm", "home_account_id",
+        "family_id", "key_id", "user_assertion_hash")
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS token_cache (
+            credential_type TEXT NOT NULL,
+            key TEXT NOT NULL,
+            {columns},
+            target TEXT,
+            usable_until INTEGER,
+            entry TEXT NOT NULL,
+            PRIMARY KEY (credential_type, key));
+        CREATE INDEX IF NOT EXISTS token_cache_by_account
+            ON token_cache (credential_type, home_account_id, environment);
+        CREATE INDEX IF NOT EXISTS token_cache_by_client
+            ON token_cache (credential_type, client_id, environment, realm);
+        CREATE INDEX IF NOT EXISTS token_cache_by_expiry
+            ON token_cache (credential_type, usable_until);
+        """.format(columns=", ".join("{} TEXT".format(c) for c in _COLUMNS))
+
+    def __init__(self, path, timeout=30):
+        """Create a token cache backed by a SQLite database.
+
+        :param str path:
+            Path to the database file, which will be created if it does not exist.
+        :param float timeout:
+            How many seconds to wait when the database is locked by a writer,
+            possibly from another process.
+        """
+        super(SqliteTokenCache, self).__init__()
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()  # sqlite3 connection is per-thread
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")  # Readers won't block writer
+        connection.executescript(self._SCHEMA)
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(
+                self._path, timeout=self._timeout,
+                isolation_level=None)  # We manage transactions by ourselves
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        # Nested usage would join the outermost transaction
+        connection = self._connect()
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            if not depth:
+                connection.execute("BEGIN IMMEDIATE")  # Obtain write lock upfront
+            yield connection
+            if not depth:
+                connection.execute("COMMIT")
+        except:
+            if not depth:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = depth
+
+    def find(self, credential_type, target=None, query=None):
+        target = target or []
+        assert isinstance(target, list), "Invalid parameter type"
+        query = query or {}
+        conditions, parameters = ["credential_type = ?"], [credential_type]
+        for field in self._COLUMNS:
+            if field in query and _bindable(query[field]):
+                conditions.append("{} IS ?".format(field))  # IS also matches NULL
+                parameters.append(query[field])
+        target_set = set(target)
+        matches = []
+        for (text,) in self._connect().execute(
+                "SELECT entry FROM token_cache WHERE {} ORDER BY rowid".format(
+                    " AND ".join(conditions)),
+                parameters):
+            entry = json.loads(text)
+            # Columns can not tell a missing field from a null one,
+            # so we still check the entire query in memory.
+            if is_subdict_of(query, entry) and (
+                    target_set <= set((entry.get("target") or "").split())
+                    if target else True):
+                matches.append(entry)
+        return matches
+
+    def _save_entries(self, entries):
+        with self._transaction():  # All entries of one event are saved atomically
+            for credential_type, entry in entries:
+                self.modify(credential_type, entry, entry)
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        # Returns whether the database was actually changed
+        key = self.key_makers[credential_type](**old_entry)
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT entry FROM token_cache WHERE credential_type = ? AND key = ?",
+                (credential_type, key)).fetchone()
+            existing = json.loads(row[0]) if row else None
+            entry = dict(old_entry, **new_key_value_pairs
+                ) if new_key_value_pairs else None
+            if entry == existing:  # Skip an identical rewrite, or a no-op removal
+                return False
+            if entry is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO token_cache "
+                    "(credential_type, key, {}, target, usable_until, entry) "
+                    "VALUES ({})".format(
+                        ", ".join(self._COLUMNS),
+                        ", ".join("?" * (len(self._COLUMNS) + 5))),
+                    [credential_type, key] + [
+                        entry.get(f) if _bindable(entry.get(f)) else None
+                        for f in self._COLUMNS] + [
+                        entry.get("target") if _bindable(entry.get("target"))
+                            else None,
+                        _get_usable_until(entry),
+                        json.dumps(entry),
+                    ])
+            else:
+                connection.execute(
+                    "DELETE FROM token_cache WHERE credential_type = ? AND key = ?",
+                    (credential_type, key))
+                with self._lock:
+                    self._suspect_orphans(credential_type, existing)
+            self._notify(credential_type, key, existing, entry)
+            return True
+
+    def compact(self, now=None):
+        """Remove expired access tokens, and the entries orphaned by removals.
+
+        Expired access tokens are located by an indexed column,
+        and deleted by one statement.
+        Orphans are only looked for among the users and apps
+        whose tokens were removed by this process.
+        See also :func:`TokenCache.compact`.
+        """
+        with self._transaction():  # Other processes would wait
+            return super(SqliteTokenCache, self).compact(now=now)
+
+    def _remove_expired_access_tokens(self, now):
+        credential_type = self.CredentialType.ACCESS_TOKEN
+        condition = "WHERE credential_type = ? AND usable_until <= ?"
+        connection = self._connect()
+        expired = connection.execute(
+            "SELECT key, entry FROM token_cache " + condition,
+            (credential_type, now)).fetchall()
+        connection.execute(
+            "DELETE FROM token_cache " + condition, (credential_type, now))
+        for key, text in expired:
+            entry = json.loads(text)
+            self._suspect_orphans(credential_type, entry)
+            self._notify(credential_type, key, entry, None)
+        return len(expired)
+
+    def _lookup(self, credential_type, query):
+        return self.find(credential_type, query=query)  # No recency to be kept
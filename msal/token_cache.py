@@ -1,9 +1,15 @@
-﻿import json
+﻿from collections import OrderedDict
+import heapq
+import itertools
+import json
 import threading
 import time
 import logging
+import re
+import zlib
 
 from .authority import canonicalize
+from .concurrency import _PublishingLock
 from .oauth2cli.oidc import decode_part, decode_id_token
 
 
@@ -13,6 +19,236 @@ def is_subdict_of(small, big):
     return dict(big, **small) == big
 
 
+def _wipe(dictionary, sensitive_fields):  # Masks sensitive info
+    for sensitive in sensitive_fields:
+        if sensitive in dictionary:
+            dictionary[sensitive] = "********"
+
+
+def _get_expires_on(entry):  # Returns an integer, or None if unavailable
+    try:
+        return int(entry["expires_on"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _get_usable_until(entry):  # Returns an integer, or None if unavailable
+    # An AT may still be served in its extended lifetime, when the STS is down.
+    # So it is not considered expired, for compaction and eviction,
+    # until both its expires_on and extended_expires_on have passed.
+    expires_on = _get_expires_on(entry)
+    try:
+        return max(expires_on, int(entry["extended_expires_on"]))
+    except (KeyError, TypeError, ValueError):
+        return expires_on
+
+
+def _get_timestamp(entry):  # When was this entry written, or 0 if unknown
+    try:
+        return int(entry.get("last_modification_time") or entry.get("cached_at") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _get_partition(entry):
+    # Entries of an end user belong to the partition of its home_account_id,
+    # and the rest (app-only tokens, app metadata) belong to that of their realm.
+    home_account_id = entry.get("home_account_id")
+    return (("home_account_id", home_account_id) if home_account_id
+        else ("realm", entry.get("realm")))
+
+
+class _Index(object):
+    """Secondary indexes which map each (field, value) to keys of matching entries.
+
+    They are maintained per credential type, so that find() would only need to
+    examine the (usually few) entries sharing all the indexed fields in a query,
+    rather than scanning every entry of that type.
+    """
+    FIELDS = (  # These are the fields being queried by application.py
+        "client_id", "environment", "realm", "home_account_id",
+        "family_id", "key_id", "user_assertion_hash")
+
+    def __init__(self):
+        self._postings = {}  # {credential_type: {(field, value): set_of_keys}}
+        self._order = {}  # {credential_type: {key: sequence}}, mimicking dict order
+        self._sources = {}  # {credential_type: the dict of entries being indexed}
+        self._sequence = itertools.count()
+        self._copied = {}  # {credential_type: pairs whose sets were copied since fork}
+
+    def clear(self):
+        self._postings, self._order, self._sources = {}, {}, {}
+        self._copied = {}
+
+    def is_stale(self, credential_type, entries):
+        # Some callers (mostly test cases) replace or populate _cache directly.
+        # We detect such a change, so that it would be re-indexed on-the-fly.
+        if not entries and not self._order.get(credential_type):
+            return False  # Nothing to index, yet
+        return not (
+            self._sources.get(credential_type) is entries
+            and len(self._order.get(credential_type, {})) == len(entries))
+
+    def rebuild(self, credential_type, entries):
+        self._postings[credential_type] = {}
+        self._order[credential_type] = {}
+        self._sources[credential_type] = entries
+        self._copied.pop(credential_type, None)
+        for key, entry in entries.items():
+            self.add(credential_type, key, entry)
+
+    def snapshot(self, credential_type, entries):
+        """Return a read-only index of entries, sharing the current structures.
+
+        They shall be left intact afterwards, so call fork() before changing them.
+        """
+        snapshot = _Index()
+        snapshot._postings[credential_type] = self._postings.setdefault(
+            credential_type, {})
+        snapshot._order[credential_type] = self._order.setdefault(
+            credential_type, {})
+        snapshot._sources[credential_type] = entries
+        return snapshot
+
+    def fork(self, credential_type, entries):
+        # Index a copy of the entries, leaving the snapshot structures intact.
+        # The (many) posting sets will be copied on demand, when being changed.
+        self._postings[credential_type] = dict(
+            self._postings.get(credential_type, {}))
+        self._order[credential_type] = dict(self._order.get(credential_type, {}))
+        self._sources[credential_type] = entries
+        self._copied[credential_type] = set()
+
+    def _get_keys_to_change(self, credential_type, pair):
+        postings = self._postings.setdefault(credential_type, {})
+        copied = self._copied.get(credential_type)
+        if copied is not None and pair not in copied:  # Copy-on-write
+            postings[pair] = set(postings.get(pair, ()))
+            copied.add(pair)
+        return postings.setdefault(pair, set())
+
+    SCOPE = "scope"  # Each scope inside a target is indexed as (SCOPE, scope)
+
+    def _pairs(self, entry, target=None):
+        for field in self.FIELDS:
+            if field in entry:
+                yield field, entry[field]
+        if target is None:
+            try:
+                target = entry.get("target", "").split()
+            except AttributeError:  # Other SDK may have stored a target as null
+                target = []
+        for scope in set(target):
+            yield self.SCOPE, scope
+
+    def add(self, credential_type, key, entry):
+        for pair in self._pairs(entry):
+            try:
+                self._get_keys_to_change(credential_type, pair).add(key)
+            except TypeError:  # Unhashable value. Such a pair won't be indexed.
+                pass
+        self._order.setdefault(credential_type, {}).setdefault(
+            key, next(self._sequence))  # An existing key retains its position
+
+    def remove(self, credential_type, key, entry, keep_position=False):
+        postings = self._postings.get(credential_type, {})
+        for pair in self._pairs(entry):
+            try:
+                if pair not in postings:
+                    continue
+                keys = self._get_keys_to_change(credential_type, pair)
+            except TypeError:
+                continue
+            keys.discard(key)
+            if not keys:
+                del postings[pair]
+        if not keep_position:
+            self._order.get(credential_type, {}).pop(key, None)
+
+    def find(self, credential_type, query, target=None):
+        """Return candidate keys in insertion order, or None if query is unindexed.
+
+        Candidates match all the indexed fields of the query,
+        and their targets contain all the scopes in the given target.
+        Caller still needs to examine the rest of the query.
+        """
+        postings = self._postings.get(credential_type, {})
+        candidates = []
+        for pair in self._pairs(query, target=target or []):
+            try:
+                candidates.append(postings.get(pair, frozenset()))
+            except TypeError:
+                pass
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        return self.sort(
+            credential_type, candidates[0].intersection(*candidates[1:]))
+
+    def sort(self, credential_type, keys):
+        """Return the keys in insertion order, which dict order is not on Python 2"""
+        return sorted(keys, key=self._order.get(credential_type, {}).__getitem__)
+
+
+class _Subscription(object):
+    # Delivers change events to a callback, optionally via a background thread
+
+    def __init__(self, callback, asynchronous=False, coalesce=False):
+        self.callback = callback
+        self._coalesce = coalesce
+        self._pending = OrderedDict() if coalesce else []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._worker = None
+        if asynchronous:
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True  # It shall not block the exit of an app
+            self._worker.start()
+
+    def _invoke(self, event):
+        try:
+            self.callback(event)
+        except Exception:
+            logger.exception("Subscriber %r failed to handle an event", self.callback)
+
+    def deliver(self, event):
+        if self._worker is None:
+            self._invoke(event)
+            return
+        with self._condition:
+            if not self._coalesce:
+                self._pending.append(event)
+            else:
+                key = (event["credential_type"], event["key"])
+                earlier = self._pending.pop(key, None)
+                if earlier is not None:  # Merge them, and requeue it as the latest
+                    event = dict(event, old=earlier["old"])
+                self._pending[key] = event
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:  # Closed and drained
+                    return
+                pending = (
+                    list(self._pending.values()) if self._coalesce
+                    else self._pending)
+                self._pending = OrderedDict() if self._coalesce else []
+            for event in pending:
+                if event["old"] != event["new"]:  # Coalesced events may cancel out
+                    self._invoke(event)
+
+    def close(self):
+        if self._worker is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            self._worker.join()
+
+
 class TokenCache(object):
     """This is considered as a base class containing minimal cache behavior.
 
@@ -32,9 +268,66 @@ class TokenCache(object):
         ADFS = "ADFS"
         MSSTS = "MSSTS"  # MSSTS means AAD v2 for both AAD & MSA
 
-    def __init__(self):
-        self._lock = threading.RLock()
+    def __init__(self, concurrent_reads=False, capacity=None, compact_interval=None):
+        """Create a token cache.
+
+        :param bool concurrent_reads:
+            By default, all cache operations are serialized by one lock.
+            When True, read-only look-ups (such as those made by
+            ``acquire_token_silent()``) would take no lock.
+            They read a snapshot, which each write replaces atomically
+            by a changed copy of the credential types it writes,
+            so look-ups neither block each other nor wait for a write.
+            In exchange, each write copies the entries and indexes
+            of the types it writes, which takes time linear to their size.
+            This may help an app serving many concurrent requests
+            from a cache which is written much less often than it is read.
+            A look-up of a bounded type (see ``capacity``) updates its recency,
+            so it still takes the lock.
+        :param capacity:
+            By default, the cache is unbounded.
+            An integer would limit the number of access tokens in the cache.
+            A dict, such as ``{TokenCache.CredentialType.ACCESS_TOKEN: 10000,
+            TokenCache.CredentialType.REFRESH_TOKEN: 1000}``,
+            would limit each of the specified credential types.
+            When a limit is exceeded, expired entries would be evicted first
+            (an access token is not considered expired
+            until its ``extended_expires_on`` has also passed),
+            and then the least recently used (i.e. added or found) entries.
+            The numbers of evictions are available in :attr:`eviction_counts`.
+        :param compact_interval:
+            By default, expired tokens remain in the cache until being replaced.
+            A number of seconds would make the cache run :func:`~compact`
+            whenever it is being written and that many seconds have elapsed
+            since the previous compaction.
+
+        :var dict eviction_counts:
+            How many entries were evicted from a bounded cache, in the shape of
+            ``{credential_type: {"expired": count, "least_recently_used": count}}``.
+        """
+        self._lock = _PublishingLock(self._publish) if concurrent_reads else (
+            threading.RLock())
         self._cache = {}
+        self._index = _Index()
+        # Snapshots of {credential_type: (entries, index)} for lock-free look-ups
+        self._snapshots = {} if concurrent_reads else None
+        self._unpublished = {}  # {credential_type: entries} copied by current write
+        self._capacity = dict(
+            capacity if isinstance(capacity, dict)
+            else {} if capacity is None
+            else {self.CredentialType.ACCESS_TOKEN: capacity})
+        self._recency = {  # {credential_type: OrderedDict of keys, oldest first}
+            credential_type: OrderedDict() for credential_type in self._capacity}
+        self._expiry = {  # {credential_type: heap of (usable_until, key)}
+            credential_type: [] for credential_type in
+                set(self._capacity) | set([self.CredentialType.ACCESS_TOKEN])}
+        self.eviction_counts = {}
+        self._compact_interval = compact_interval
+        self._next_compaction = time.time() + (compact_interval or 0)
+        # Removals leave these suspects, to be examined by the next compact()
+        self._orphaned_users = set()  # {(home_account_id, environment)}
+        self._orphaned_apps = set()  # {(environment, client_id)}
+        self._subscriptions = []
         self.key_makers = {
             self.CredentialType.REFRESH_TOKEN:
                 lambda home_account_id=None, environment=None, client_id=None,
@@ -85,17 +378,78 @@ class TokenCache(object):
     def find(self, credential_type, target=None, query=None):
         target = target or []
         assert isinstance(target, list), "Invalid parameter type"
-        target_set = set(target)
+        if self._is_copied_on_write(credential_type) and not self._lock.is_held():
+            entries, index = self._get_snapshot(credential_type)
+            return [entry for _, entry in self._find_in(
+                entries, index, credential_type, target, query or {})]
         with self._lock:
-            # Since the target inside token cache key is (per schema) unsorted,
-            # there is no point to attempt an O(1) key-value search here.
-            # So we always do an O(n) in-memory search.
-            return [entry
-                for entry in self._cache.get(credential_type, {}).values()
-                if is_subdict_of(query or {}, entry)
-                and (target_set <= set(entry.get("target", "").split())
-		    if target else True)
-                ]
+            matches = self._find_in(
+                self._get_indexed_entries(credential_type), self._index,
+                credential_type, target, query or {})
+            recency = self._recency.get(credential_type)
+            if recency is not None:  # Only a bounded type needs this bookkeeping
+                for key, _ in matches:
+                    if recency.pop(key, False) is None:  # Only touch a known key
+                        recency[key] = None
+            return [entry for _, entry in matches]
+
+    def _find_in(self, entries, index, credential_type, target, query):
+        # Returns a list of (key, entry) matching the query, in insertion order.
+        # Since the target inside token cache key is (per schema) unsorted,
+        # there is no point to attempt an O(1) key-value search here.
+        # Instead, we narrow down the candidates by secondary indexes,
+        # whose per-scope postings also take care of the target matching.
+        # An unindexed query would fall back to an O(n) in-memory search.
+        keys = index.find(credential_type, query, target=target)
+        candidates = entries.items() if keys is None else [
+            (k, entries[k]) for k in keys if k in entries]
+        matches = [(key, entry)
+            for key, entry in candidates if is_subdict_of(query, entry)]
+        if keys is None:  # Sorted alike, so the order won't depend on the query
+            matches = [(key, entries[key]) for key in index.sort(
+                credential_type, [key for key, _ in matches])]
+        return matches
+
+    def _is_copied_on_write(self, credential_type):
+        # Only in concurrent_reads mode, and a bounded type is excluded,
+        # because its look-ups update its recency, which is a write.
+        return self._snapshots is not None and credential_type not in self._recency
+
+    def _get_snapshot(self, credential_type):
+        # Returns the (entries, index) last published, normally without lock
+        snapshot = self._snapshots.get(credential_type)
+        entries = self._cache.get(credential_type, {})
+        if snapshot is None or (
+                snapshot[1].is_stale(credential_type, entries)  # _cache replaced
+                and entries is not self._unpublished.get(credential_type)):
+            with self._lock:  # The snapshot would be published on release
+                self._unpublished[credential_type] = self._get_indexed_entries(
+                    credential_type)
+            snapshot = self._snapshots[credential_type]
+        return snapshot
+
+    def _fork(self, credential_type, entries):
+        # Copy-on-write. The published snapshot of this type is left intact,
+        # and the write changes a copy, to be published when it releases the lock.
+        published = credential_type in self._snapshots
+        if published:
+            entries = dict(entries)
+        self._unpublished[credential_type] = entries  # Before readers see it
+        if published:
+            self._cache[credential_type] = entries
+            self._index.fork(credential_type, entries)
+        return entries
+
+    def _publish(self):
+        # Called by the lock, before the outermost release of a write
+        if self._unpublished:
+            snapshots = dict(self._snapshots)
+            for credential_type in list(self._unpublished):
+                entries = self._get_indexed_entries(credential_type)
+                snapshots[credential_type] = (
+                    entries, self._index.snapshot(credential_type, entries))
+            self._snapshots = snapshots  # Readers switch to all of them at once
+            self._unpublished = {}
 
     def add(self, event, now=None):
         # type: (dict) -> None
@@ -103,24 +457,71 @@ class TokenCache(object):
 
         Known side effects: This function modifies the input event in place.
         """
-        def wipe(dictionary, sensitive_fields):  # Masks sensitive info
-            for sensitive in sensitive_fields:
-                if sensitive in dictionary:
-                    dictionary[sensitive] = "********"
-        wipe(event.get("data", {}),
+        _wipe(event.get("data", {}),
             ("password", "client_secret", "refresh_token", "assertion"))
         try:
             return self.__add(event, now=now)
         finally:
-            wipe(event.get("response", {}), (  # These claims were useful during __add()
+            _wipe(event.get("response", {}), (  # These claims were useful during __add()
                 "access_token", "refresh_token", "id_token", "username"))
-            wipe(event, ["username"])  # Needed for federated ROPC
-            logger.debug("event=%s", json.dumps(
-            # We examined and concluded that this log won't have Log Injection risk,
-            # because the event payload is already in JSON so CR/LF will be escaped.
-                event, indent=4, sort_keys=True,
-                default=str,  # A workaround when assertion is in bytes in Python 3
-                ))
+            _wipe(event, ["username"])  # Needed for federated ROPC
+            if logger.isEnabledFor(logging.DEBUG):  # Skip the costly json.dumps()
+                logger.debug("event=%s", json.dumps(
+                # We examined and concluded that this log won't have Log Injection risk,
+                # because the event payload is already in JSON so CR/LF will be escaped.
+                    event, indent=4, sort_keys=True,
+                    default=str,  # A workaround when assertion is in bytes in Python 3
+                    ))
+
+    def add_many(self, events, now=None):
+        # type: (Iterable[dict], Optional[int]) -> None
+        """Handle many token obtaining events, such as those in a bulk migration.
+
+        The result is the same as calling :func:`~add` for each event in order,
+        but all tokens are saved in one batch, under one lock acquisition.
+        An entry appearing in multiple events would only be saved once,
+        with its value from the last of those events.
+        Unlike :func:`~add`, the events are not logged one by one.
+
+        Each entry is still saved and indexed one by one,
+        so an in-memory cache would ingest at about the same speed as add().
+        The batch pays off on a persisted cache, such as
+        :class:`~msal.persistence.MmapTokenCache` which rewrites its file once,
+        or :class:`~msal.sqlite_token_cache.SqliteTokenCache`
+        which commits one transaction, rather than once per event.
+
+        All events are parsed before any of them is saved,
+        so an invalid event, such as one with a malformed ID token,
+        raises an exception with nothing saved.
+        The batch is not all-or-nothing beyond that, though.
+        A failure while saving, such as an exception from a synchronous
+        subscriber, may leave the batch partially applied,
+        unless the cache is a :class:`~msal.sqlite_token_cache.SqliteTokenCache`
+        whose transaction would be rolled back.
+
+        Known side effects: This function modifies the input events in place.
+        """
+        entries = OrderedDict()  # {(credential_type, key): entry}
+        count = 0
+        for event in events:
+            _wipe(event.get("data", {}),
+                ("password", "client_secret", "refresh_token", "assertion"))
+            try:
+                for credential_type, entry in self.__parse(event, now=now):
+                    entries[(
+                        credential_type,
+                        self.key_makers[credential_type](**entry),
+                        )] = entry
+            finally:
+                _wipe(event.get("response", {}), (
+                    "access_token", "refresh_token", "id_token", "username"))
+                _wipe(event, ["username"])
+            count += 1
+        self._save_entries([
+            (credential_type, entry)
+            for (credential_type, _), entry in entries.items()])
+        logger.debug("Added %d entries from %d events", len(entries), count)
+        self._compact_if_due()
 
     def __parse_account(self, response, id_token_claims):
         """Return client_info and home_account_id"""
@@ -136,6 +537,15 @@ class TokenCache(object):
         return {}, None
 
     def __add(self, event, now=None):
+        self._save_entries(self.__parse(event, now=now))
+        self._compact_if_due()
+
+    def _compact_if_due(self):
+        if self._compact_interval and time.time() >= self._next_compaction:
+            self.compact()
+
+    def __parse(self, event, now=None):
+        # Returns a list of (credential_type, entry) to be saved.
         # event typically contains: client_id, scope, token_endpoint,
         # response, params, data, grant_type
         environment = realm = None
@@ -155,86 +565,98 @@ class TokenCache(object):
 
         target = ' '.join(event.get("scope") or [])  # Per schema, we don't sort it
 
-        with self._lock:
-            now = int(time.time() if now is None else now)
+        now = int(time.time() if now is None else now)
+        entries = []  # A list of (credential_type, entry) to be saved
 
-            if access_token:
-                expires_in = int(  # AADv1-like endpoint returns a string
+        if access_token:
+            expires_in = int(  # AADv1-like endpoint returns a string
 			response.get("expires_in", 3599))
-                ext_expires_in = int(  # AADv1-like endpoint returns a string
+            ext_expires_in = int(  # AADv1-like endpoint returns a string
 			response.get("ext_expires_in", expires_in))
-                at = {
-                    "credential_type": self.CredentialType.ACCESS_TOKEN,
-                    "secret": access_token,
-                    "home_account_id": home_account_id,
-                    "environment": environment,
-                    "client_id": event.get("client_id"),
-                    "target": target,
-                    "realm": realm,
-                    "token_type": response.get("token_type", "Bearer"),
-                    "cached_at": str(now),  # Schema defines it as a string
-                    "expires_on": str(now + expires_in),  # Same here
-                    "extended_expires_on": str(now + ext_expires_in)  # Same here
-                    }
-                if data.get("key_id"):  # It happens in SSH-cert or POP scenario
-                    at["key_id"] = data.get("key_id")
-                if "refresh_in" in response:
-                    refresh_in = response["refresh_in"]  # It is an integer
-                    at["refresh_on"] = str(now + refresh_in)  # Schema wants a string
-                self.modify(self.CredentialType.ACCESS_TOKEN, at, at)
-
-            if client_info and not event.get("skip_account_creation"):
-                account = {
-                    "home_account_id": home_account_id,
-                    "environment": environment,
-                    "realm": realm,
-                    "local_account_id": id_token_claims.get(
-                        "oid", id_token_claims.get("sub")),
-                    "username": id_token_claims.get("preferred_username")  # AAD
-                        or id_token_claims.get("upn")  # ADFS 2019
-                        or data.get("username")  # Falls back to ROPC username
-                        or event.get("username")  # Falls back to Federated ROPC username
-                        or "",  # The schema does not like null
-                    "authority_type":
-                        self.AuthorityType.ADFS if realm == "adfs"
-                        else self.AuthorityType.MSSTS,
-                    # "client_info": response.get("client_info"),  # Optional
-                    }
-                self.modify(self.CredentialType.ACCOUNT, account, account)
-
-            if id_token:
-                idt = {
-                    "credential_type": self.CredentialType.ID_TOKEN,
-                    "secret": id_token,
-                    "home_account_id": home_account_id,
-                    "environment": environment,
-                    "realm": realm,
-                    "client_id": event.get("client_id"),
-                    # "authority": "it is optional",
-                    }
-                self.modify(self.CredentialType.ID_TOKEN, idt, idt)
-
-            if refresh_token:
-                rt = {
-                    "credential_type": self.CredentialType.REFRESH_TOKEN,
-                    "secret": refresh_token,
-                    "home_account_id": home_account_id,
-                    "environment": environment,
-                    "client_id": event.get("client_id"),
-                    "target": target,  # Optional per schema though
-                    "last_modification_time": str(now),  # Optional. Schema defines it as a string.
-                    }
-                if "foci" in response:
-                    rt["family_id"] = response["foci"]
-                self.modify(self.CredentialType.REFRESH_TOKEN, rt, rt)
-
-            app_metadata = {
+            at = {
+                "credential_type": self.CredentialType.ACCESS_TOKEN,
+                "secret": access_token,
+                "home_account_id": home_account_id,
+                "environment": environment,
                 "client_id": event.get("client_id"),
+                "target": target,
+                "realm": realm,
+                "token_type": response.get("token_type", "Bearer"),
+                "cached_at": str(now),  # Schema defines it as a string
+                "expires_on": str(now + expires_in),  # Same here
+                "extended_expires_on": str(now + ext_expires_in)  # Same here
+                }
+            if data.get("key_id"):  # It happens in SSH-cert or POP scenario
+                at["key_id"] = data.get("key_id")
+            if event.get("user_assertion_hash"):  # It happens in OBO scenario
+                at["user_assertion_hash"] = event["user_assertion_hash"]
+            if "refresh_in" in response:
+                refresh_in = response["refresh_in"]  # It is an integer
+                at["refresh_on"] = str(now + refresh_in)  # Schema wants a string
+            entries.append((self.CredentialType.ACCESS_TOKEN, at))
+
+        if client_info and not event.get("skip_account_creation"):
+            account = {
+                "home_account_id": home_account_id,
                 "environment": environment,
+                "realm": realm,
+                "local_account_id": id_token_claims.get(
+                    "oid", id_token_claims.get("sub")),
+                "username": id_token_claims.get("preferred_username")  # AAD
+                    or id_token_claims.get("upn")  # ADFS 2019
+                    or data.get("username")  # Falls back to ROPC username
+                    or event.get("username")  # Falls back to Federated ROPC username
+                    or "",  # The schema does not like null
+                "authority_type":
+                    self.AuthorityType.ADFS if realm == "adfs"
+                    else self.AuthorityType.MSSTS,
+                # "client_info": response.get("client_info"),  # Optional
+                }
+            entries.append((self.CredentialType.ACCOUNT, account))
+
+        if id_token:
+            idt = {
+                "credential_type": self.CredentialType.ID_TOKEN,
+                "secret": id_token,
+                "home_account_id": home_account_id,
+                "environment": environment,
+                "realm": realm,
+                "client_id": event.get("client_id"),
+                # "authority": "it is optional",
+                }
+            entries.append((self.CredentialType.ID_TOKEN, idt))
+
+        if refresh_token:
+            rt = {
+                "credential_type": self.CredentialType.REFRESH_TOKEN,
+                "secret": refresh_token,
+                "home_account_id": home_account_id,
+                "environment": environment,
+                "client_id": event.get("client_id"),
+                "target": target,  # Optional per schema though
+                "last_modification_time": str(now),  # Optional. Schema defines it as a string.
                 }
             if "foci" in response:
-                app_metadata["family_id"] = response.get("foci")
-            self.modify(self.CredentialType.APP_METADATA, app_metadata, app_metadata)
+                rt["family_id"] = response["foci"]
+            if event.get("user_assertion_hash"):  # It happens in OBO scenario
+                rt["user_assertion_hash"] = event["user_assertion_hash"]
+            entries.append((self.CredentialType.REFRESH_TOKEN, rt))
+
+        app_metadata = {
+            "client_id": event.get("client_id"),
+            "environment": environment,
+            }
+        if "foci" in response:
+            app_metadata["family_id"] = response.get("foci")
+        entries.append((self.CredentialType.APP_METADATA, app_metadata))
+        return entries
+
+    def _save_entries(self, entries):
+        # Save the (credential_type, entry) pairs obtained from one event.
+        # They are saved atomically, i.e. readers won't observe half of them.
+        with self._lock:
+            for credential_type, entry in entries:
+                self.modify(credential_type, entry, entry)
 
     def modify(self, credential_type, old_entry, new_key_value_pairs=None):
         # Modify the specified old_entry with new_key_value_pairs,
@@ -244,15 +666,274 @@ class TokenCache(object):
         # so that the sub-classes will have only one method to work on,
         # instead of patching a pair of update_xx() and remove_xx() per type.
         # You can monkeypatch self.key_makers to support more types on-the-fly.
+
+        # Returns whether the cache was actually changed.
         key = self.key_makers[credential_type](**old_entry)
         with self._lock:
-            if new_key_value_pairs:  # Update with them
-                entries = self._cache.setdefault(credential_type, {})
-                entries[key] = dict(
+            changed = self._put_entry(
+                credential_type, key,
+                dict(
                     old_entry,  # Do not use entries[key] b/c it might not exist
                     **new_key_value_pairs)
-            else:  # Remove old_entry
-                self._cache.setdefault(credential_type, {}).pop(key, None)
+                if new_key_value_pairs  # Update with them
+                else None)  # Remove old_entry
+            if changed and new_key_value_pairs and credential_type in self._capacity:
+                self._evict(credential_type)
+            return changed
+
+    def _evict(self, credential_type, now=None):
+        # Evict entries until this credential_type is within its capacity.
+        # Each eviction goes through modify(), so that subclasses would notice.
+        entries = self._cache.get(credential_type, {})
+        capacity = self._capacity[credential_type]
+        recency = self._recency[credential_type]
+        now = time.time() if now is None else now
+        counts = self.eviction_counts.setdefault(
+            credential_type, {"expired": 0, "least_recently_used": 0})
+        if len(recency) != len(entries):
+            # Some entries were deserialized or added without our bookkeeping.
+            # They are considered as less recently used than the known ones.
+            known = [key for key in recency if key in entries]
+            known_keys = set(known)
+            recency.clear()
+            for key in itertools.chain(
+                    (key for key in entries if key not in known_keys), known):
+                recency[key] = None
+            self._rebuild_expiry(credential_type, entries)
+        expired = self._pop_expired(credential_type, now)
+        while len(entries) > capacity:
+            entry = next(expired, None)
+            if entry is None:
+                break
+            self.modify(credential_type, entry)  # Remove it
+            counts["expired"] += 1
+        while len(entries) > capacity:
+            key = next(iter(recency))
+            self.modify(credential_type, entries[key])  # Remove it
+            if key in entries:  # Its key was not made by key_makers
+                self._put_entry(credential_type, key, None)
+            counts["least_recently_used"] += 1
+
+    def _rebuild_expiry(self, credential_type, entries):
+        expiry = self._expiry[credential_type]
+        expiry[:] = [(_get_usable_until(entry), key)
+            for key, entry in entries.items()
+            if _get_usable_until(entry) is not None]
+        heapq.heapify(expiry)
+
+    def _pop_expired(self, credential_type, now):
+        # Yields each expired entry, in the order of their _get_usable_until()
+        entries = self._cache.get(credential_type, {})
+        expiry = self._expiry[credential_type]
+        while expiry and expiry[0][0] <= now:
+            usable_until, key = heapq.heappop(expiry)
+            entry = entries.get(key)
+            if entry is not None and _get_usable_until(entry) == usable_until:
+                yield entry  # Otherwise it was an outdated heap item
+
+    def compact(self, now=None):
+        """Remove expired access tokens, and the entries orphaned by removals.
+
+        An access token is considered expired here only when both its
+        ``expires_on`` and ``extended_expires_on`` have passed,
+        so that it could still be served during an outage of the STS.
+        See also the ``serve_stale_tokens`` parameter of
+        :class:`~msal.ClientApplication`.
+
+        Orphans are app metadata of an app which has no token left,
+        as well as ID tokens and accounts of a user who has neither
+        refresh token nor access token left.
+        Both expired tokens and orphans are located without a full scan,
+        so this can be called frequently.
+        See also the ``compact_interval`` parameter of :func:`~__init__`.
+        Entries visited here are not considered as recently used,
+        so compaction won't shield them from eviction by ``capacity``.
+
+        :return: The number of entries removed.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._next_compaction = time.time() + (self._compact_interval or 0)
+            removed = self._remove_expired_access_tokens(now)
+            removed += self._remove_orphaned_users()
+            apps, self._orphaned_apps = self._orphaned_apps, set()
+            for environment, client_id in apps:
+                if not self._has_tokens_of_app(environment, client_id):
+                    removed += self._remove_app_metadata(environment, client_id)
+        if removed:
+            logger.debug("Compaction removed %d entries", removed)
+        return removed
+
+    def _remove_expired_access_tokens(self, now):  # Returns how many are removed
+        self._get_indexed_entries(self.CredentialType.ACCESS_TOKEN)
+        expired = list(self._pop_expired(self.CredentialType.ACCESS_TOKEN, now))
+        for at in expired:
+            self.modify(self.CredentialType.ACCESS_TOKEN, at)
+        return len(expired)
+
+    def _remove_orphaned_users(self):  # Returns how many entries are removed
+        removed = 0
+        users, self._orphaned_users = self._orphaned_users, set()
+        for home_account_id, environment in users:
+            query = {"home_account_id": home_account_id, "environment": environment}
+            if not (self._lookup(self.CredentialType.REFRESH_TOKEN, query)
+                    or self._lookup(self.CredentialType.ACCESS_TOKEN, query)):
+                for credential_type in (
+                        self.CredentialType.ID_TOKEN, self.CredentialType.ACCOUNT):
+                    for entry in self._lookup(credential_type, query):
+                        self.modify(credential_type, entry)
+                        removed += 1
+        return removed
+
+    def _has_tokens_of_app(self, environment, client_id):
+        query = {"environment": environment, "client_id": client_id}
+        return any(self._lookup(credential_type, query) for credential_type in (
+            self.CredentialType.REFRESH_TOKEN,
+            self.CredentialType.ACCESS_TOKEN,
+            self.CredentialType.ID_TOKEN))
+
+    def _remove_app_metadata(self, environment, client_id):
+        # Returns how many entries are removed
+        entries = self._lookup(self.CredentialType.APP_METADATA, {
+            "environment": environment, "client_id": client_id})
+        for entry in entries:
+            self.modify(self.CredentialType.APP_METADATA, entry)
+        return len(entries)
+
+    def _lookup(self, credential_type, query):
+        # Unlike find(), it does not update the recency of a bounded type,
+        # so that housekeeping won't make an entry look recently used.
+        with self._lock:
+            return [entry for _, entry in self._find_in(
+                self._get_indexed_entries(credential_type), self._index,
+                credential_type, [], query)]
+
+    def _suspect_orphans(self, credential_type, removed_entry):
+        # Remember whose ID tokens, accounts or app metadata may be orphaned
+        # by the removal of a token, so that compact() would check them
+        if credential_type in (
+                self.CredentialType.ACCESS_TOKEN,
+                self.CredentialType.REFRESH_TOKEN,
+                self.CredentialType.ID_TOKEN):
+            if removed_entry.get("home_account_id"):
+                self._orphaned_users.add((
+                    removed_entry["home_account_id"],
+                    removed_entry.get("environment")))
+            self._orphaned_apps.add(
+                (removed_entry.get("environment"), removed_entry.get("client_id")))
+
+    def _put_entry(self, credential_type, key, entry):
+        # Store the entry under the key, or remove the key if entry is None,
+        # and keep the indexes up-to-date. Caller shall hold self._lock.
+        # Returns False if it was a no-op, such as rewriting an identical entry.
+        entries = self._get_indexed_entries(
+            credential_type, self._cache.setdefault(credential_type, {}))
+        existing = entries.get(key)
+        recency = self._recency.get(credential_type)
+        if entry == existing:  # Including the removal of a non-existent entry
+            if entry is not None and recency is not None and key in recency:
+                recency.pop(key)
+                recency[key] = None  # An identical rewrite still counts as a use
+            return False
+        if self._is_copied_on_write(credential_type) and (
+                credential_type not in self._unpublished):
+            entries = self._fork(credential_type, entries)
+        if existing is not None:
+            self._index.remove(
+                credential_type, key, existing, keep_position=entry is not None)
+        if entry is not None:
+            entries[key] = entry
+            self._index.add(credential_type, key, entry)
+        else:
+            entries.pop(key, None)
+        if recency is not None:  # This is a bounded type
+            recency.pop(key, None)
+            if entry is not None:
+                recency[key] = None  # As the most recently used
+        expiry = self._expiry.get(credential_type)
+        if expiry is not None and entry is not None:
+            usable_until = _get_usable_until(entry)
+            if usable_until is not None:
+                heapq.heappush(expiry, (usable_until, key))
+            if len(expiry) > 2 * len(entries) + 100:  # Purge outdated heap items
+                self._rebuild_expiry(credential_type, entries)
+        if entry is None and existing is not None:
+            self._suspect_orphans(credential_type, existing)
+        self._notify(credential_type, key, existing, entry)
+        return True
+
+    def subscribe(self, callback, asynchronous=False, coalesce=False):
+        """Subscribe to the changes of this cache.
+
+        This allows a replication or persistence layer to push only the
+        changed entries to an external store, rather than the entire cache.
+
+        :param callback:
+            A callable receiving one change event, which is a dict like this::
+
+                {
+                    "credential_type": "AccessToken",
+                    "key": "the-key-of-this-entry",
+                    "old": {...},  # The previous entry, or None if it was absent
+                    "new": {...},  # The current entry, or None if it is removed
+                    "removed": False,
+                }
+
+            An identical rewrite is not a change, so it triggers no event.
+            Exceptions raised by the callback will be logged and ignored.
+        :param bool asynchronous:
+            By default, the callback is invoked synchronously,
+            while the cache is still locked by the write,
+            so it shall return quickly.
+            When True, events will be queued and delivered in order
+            by a background thread.
+        :param bool coalesce:
+            Only applicable to asynchronous delivery.
+            When True, the events of one key still waiting in the queue
+            are merged into one, whose "old" is the oldest one and whose "new"
+            is the latest one. A burst of writes to one entry would then
+            be delivered as one event.
+        """
+        if coalesce and not asynchronous:
+            raise ValueError("coalesce is only applicable to asynchronous delivery")
+        subscription = _Subscription(callback, asynchronous, coalesce)
+        with self._lock:
+            self._subscriptions.append(subscription)
+
+    def unsubscribe(self, callback):
+        """Stop the subscription of a callback.
+
+        Events already queued for an asynchronous callback will be delivered
+        before this method returns.
+        """
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.callback == callback]
+            for subscription in subscriptions:
+                self._subscriptions.remove(subscription)
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _notify(self, credential_type, key, old, new):
+        if self._subscriptions:
+            event = {
+                "credential_type": credential_type,
+                "key": key,
+                "old": old,
+                "new": new,
+                "removed": new is None,
+                }
+            for subscription in list(self._subscriptions):
+                subscription.deliver(event)
+
+    def _get_indexed_entries(self, credential_type, entries=None):
+        # Returns entries of this credential_type, with their index up-to-date
+        if entries is None:
+            entries = self._cache.get(credential_type, {})
+        if self._index.is_stale(credential_type, entries):
+            self._index.rebuild(credential_type, entries)
+            if credential_type in self._expiry:
+                self._rebuild_expiry(credential_type, entries)
+        return entries
 
     def remove_rt(self, rt_item):
         assert rt_item.get("credential_type") == self.CredentialType.REFRESH_TOKEN
@@ -297,32 +978,478 @@ class SerializableTokenCache(TokenCache):
         app = msal.ClientApplication(..., token_cache=cache)
         ...
 
+    A large cache would be expensive to be rewritten as a whole after each change.
+    In that case, you may append only the changes to a journal,
+    and occasionally compact the journal and the snapshot back into a full state::
+
+        with open("my_cache.journal", "a") as journal:
+            journal.write(cache.serialize_delta() + "\n")  # After each change
+        ...
+        cache.deserialize(open("my_cache.bin", "r").read())  # Compaction
+        cache.apply_delta(open("my_cache.journal", "r").read())
+        open("my_cache.bin", "w").write(cache.serialize())
+        open("my_cache.journal", "w").close()  # Truncate the journal
+
     :var bool has_state_changed:
         Indicates whether the cache state in the memory has changed since last
-        :func:`~serialize` or :func:`~deserialize` call.
+        :func:`~serialize`, :func:`~serialize_delta` or :func:`~deserialize` call.
+        Rewriting an entry with identical content is not a change.
+    :var set changed_credential_types:
+        The credential types (such as ``"AccessToken"``) which have changed
+        since the same checkpoint, so that a persistence layer storing
+        each type separately may skip the unchanged ones.
     """
     has_state_changed = False
 
-    def add(self, event, **kwargs):
-        super(SerializableTokenCache, self).add(event, **kwargs)
-        self.has_state_changed = True
+    class Format:
+        JSON = "json"  # Pretty-printed JSON, which is the default
+        COMPACT_JSON = "compact_json"  # JSON without whitespace
+        ZLIB = "zlib"  # Compact JSON compressed by zlib, in bytes
+
+    VERSION_KEY = "StateVersion"  # A top-level key, unused by the cache schema
+
+    def __init__(self, json_codec=None, versioned=False, **kwargs):
+        """Create a serializable token cache.
+
+        :param json_codec:
+            An optional module or object providing ``dumps(obj)`` and ``loads(s)``,
+            such as a faster JSON library.
+            It will be used by all but the pretty-printed :attr:`Format.JSON`.
+            Its ``dumps()`` may return either str or utf-8 bytes.
+        :param bool versioned:
+            If True, each :func:`~serialize` after a change would stamp
+            an incremented :attr:`version` into the state,
+            so that processes sharing one persisted state can detect
+            whether it has been rewritten by others,
+            and then :func:`~merge` it before overwriting it.
+            See also :func:`msal.persistence.save_with_merge`.
+
+        :var int version:
+            The version of the state last deserialized, merged or serialized.
+            It is 0 when the state was not versioned.
+        """
+        super(SerializableTokenCache, self).__init__(**kwargs)
+        self._json_codec = json_codec
+        self._versioned = versioned
+        self.version = 0
+        self._delta = {}  # {credential_type: {key: entry_or_None_if_removed}}
+        self._removed = {}  # {credential_type: {key: entry_removed_by_delta}}
+        self.changed_credential_types = set()
+        self._lazy = {}  # {credential_type: (state, start, end)} yet to be loaded
+        self._lazy_order = []  # Top-level keys of a lazily deserialized state
+
+    def _dumps(self, obj):  # Returns compact JSON string
+        if self._json_codec is None:
+            return json.dumps(obj, separators=(",", ":"))
+        result = self._json_codec.dumps(obj)
+        return result.decode("utf-8") if isinstance(result, bytes) else result
+
+    def _loads(self, state):  # Accepts any format produced by serialize()
+        if isinstance(state, bytes) and state[:1] == b"x":  # A zlib header.
+            # JSON would not start with an "x".
+            state = zlib.decompress(state)
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        return (self._json_codec or json).loads(state)
 
     def modify(self, credential_type, old_entry, new_key_value_pairs=None):
-        super(SerializableTokenCache, self).modify(
-            credential_type, old_entry, new_key_value_pairs)
-        self.has_state_changed = True
+        with self._lock:
+            key = self.key_makers[credential_type](**old_entry)
+            if not new_key_value_pairs:  # merge() would need what is removed
+                self._materialize(credential_type)
+                existing = self._cache.get(credential_type, {}).get(key)
+            changed = super(SerializableTokenCache, self).modify(
+                credential_type, old_entry, new_key_value_pairs)
+            if changed:  # An identical rewrite won't dirty the cache
+                self._delta.setdefault(credential_type, {})[key] = self._cache.get(
+                    credential_type, {}).get(key)
+                if not new_key_value_pairs:
+                    self._removed.setdefault(credential_type, {})[key] = existing
+                self.changed_credential_types.add(credential_type)
+                self.has_state_changed = True
+            return changed
+
+    def deserialize(self, state, lazy=False):
+        # type: (Optional[Union[str, bytes]], bool) -> None
+        """Deserialize the cache from a state previously obtained by serialize()
+
+        Its format will be detected automatically.
+
+        :param bool lazy:
+            If True, and the state is in the default :attr:`Format.JSON`,
+            each credential type would only be parsed when it is first used.
+            This reduces the start-up time and memory footprint of a process
+            which only needs, for example, one access token from a large cache.
+            In this mode, the state can also be a memory-mapped file
+            (an ``mmap.mmap`` object) which shall remain open until
+            the next :func:`~deserialize` or :func:`~serialize`.
+            Other formats would still be deserialized eagerly.
+        """
+        with self._lock:
+            self._lazy = self._locate_partitions(state) if lazy and state else {}
+            self._lazy_order = sorted(self._lazy, key=lambda k: self._lazy[k][1])
+            if self._lazy:
+                self._cache = {}
+            else:
+                if state and not isinstance(state, (bytes, type(u""))):
+                    state = state[:]  # Read the whole mmap
+                self._cache = self._loads(state) if state else {}
+            self._index.clear()  # Each type will be re-indexed when first used
+            self._materialize(self.VERSION_KEY)
+            self._checkpoint(self._cache.get(self.VERSION_KEY) or 0)
+
+    def _checkpoint(self, version):
+        self.version = version
+        self._delta = {}
+        self._removed = {}
+        self.changed_credential_types = set()
+        self.has_state_changed = False
 
-    def deserialize(self, state):
-        # type: (Optional[str]) -> None
-        """Deserialize the cache from a state previously obtained by serialize()"""
+    def get_version(self, state):
+        # type: (Union[str, bytes]) -> int
+        """Returns the version stamped in a state, or 0 if it is not versioned."""
+        return (self._loads(state).get(self.VERSION_KEY) or 0) if state else 0
+
+    def merge(self, state):
+        # type: (Optional[Union[str, bytes]]) -> None
+        """Merge a state, typically re-read from a shared storage, into this cache.
+
+        The state replaces the current content of this cache,
+        except the entries changed by this cache since the last checkpoint
+        (see :attr:`has_state_changed`), which are re-applied on top of it.
+        If the same entry was also changed in the state, the one with a later
+        ``last_modification_time`` (or ``cached_at``) wins,
+        so a refresh token rotated by another process would not be clobbered.
+        Likewise, an entry removed by this cache remains removed,
+        unless the state has a newer entry than the one being removed.
+
+        Afterwards, :attr:`version` becomes that of the state,
+        and the re-applied changes remain unsaved.
+        """
         with self._lock:
-            self._cache = json.loads(state) if state else {}
-            self.has_state_changed = False  # reset
+            delta, removed = self._delta, self._removed
+            self.deserialize(state)
+            for credential_type, changes in delta.items():
+                entries = self._cache.get(credential_type, {})
+                for key, entry in changes.items():
+                    theirs = entries.get(key)
+                    ours = entry if entry is not None else removed.get(
+                        credential_type, {}).get(key)  # Compare to the removed one
+                    if ours is not None and theirs is not None and (
+                            _get_timestamp(theirs) > _get_timestamp(ours)):
+                        continue  # Theirs is newer
+                    if self._put_entry(credential_type, key, entry):
+                        self._delta.setdefault(credential_type, {})[key] = entry
+                        if entry is None:
+                            self._removed.setdefault(credential_type, {})[key] = ours
+                        self.changed_credential_types.add(credential_type)
+                        self.has_state_changed = True
+
+    _TOP_LEVEL_KEY = re.compile(r'"((?:[^"\\]|\\.)*)": ')
+
+    def _locate_partitions(self, state):
+        # Returns {key: (state, start, end)} for each top-level key,
+        # or {} if state is not in the layout of json.dumps(..., indent=4).
+        # That layout is recognizable without parsing, because JSON strings
+        # contain no raw newline, and nested keys would be indented further.
+        is_text = isinstance(state, type(u""))
+        encoded = (lambda s: s) if is_text else (lambda s: s.encode("utf-8"))
+        pattern = self._TOP_LEVEL_KEY if is_text else re.compile(
+            self._TOP_LEVEL_KEY.pattern.encode("utf-8"))
+        if not re.match(encoded(r'\{\r?\n    "'), state[:16]):
+            return {}
+        marker = encoded('\n    "')
+        spans = []  # [(position_of_key, key, start_of_value)]
+        position = state.find(marker)
+        while position >= 0:
+            match = pattern.match(state, position + len(marker) - 1)
+            if not match:
+                return {}
+            key = match.group(1)
+            spans.append((
+                position,
+                json.loads(u'"{}"'.format(key if is_text else key.decode("utf-8"))),
+                match.end()))
+            position = state.find(marker, match.end())
+        ends = [position for position, _, _ in spans[1:]] + [
+            state.rfind(encoded("}"))]
+        return {key: (state, start, end)
+            for (_, key, start), end in zip(spans, ends)}
+
+    def _materialize(self, credential_type):
+        if credential_type not in self._lazy:  # Quick check without lock
+            return
+        with self._lock:
+            if credential_type not in self._lazy:
+                return
+            state, start, end = self._lazy.pop(credential_type)
+            chunk = state[start:end].rstrip()
+            chunk = chunk.rstrip(b"," if isinstance(chunk, bytes) else u",")
+            try:
+                self._cache[credential_type] = self._loads(chunk)
+            except ValueError:  # Unexpected layout. Fall back to parse it all.
+                logger.warning("Unable to partially deserialize %s", credential_type)
+                everything = self._loads(
+                    state if isinstance(state, (bytes, type(u""))) else state[:])
+                for key in list(self._lazy) + [credential_type]:
+                    self._cache[key] = everything.get(key)
+                self._lazy = {}
+
+    def find(self, credential_type, target=None, query=None):
+        self._materialize(credential_type)
+        return super(SerializableTokenCache, self).find(
+            credential_type, target=target, query=query)
+
+    def _put_entry(self, credential_type, key, entry):
+        self._materialize(credential_type)
+        return super(SerializableTokenCache, self)._put_entry(
+            credential_type, key, entry)
 
-    def serialize(self):
+    def compact(self, now=None):
+        with self._lock:
+            for credential_type in list(self._lazy):
+                self._materialize(credential_type)
+            return super(SerializableTokenCache, self).compact(now=now)
+
+    def serialize(self, format=Format.JSON):
+        # type: (str) -> Union[str, bytes]
+        """Serialize the current cache state into a string.
+
+        :param str format:
+            One of the :class:`SerializableTokenCache.Format`.
+            Defaults to a pretty-printed JSON string.
+            A compact format would be smaller and faster to be transferred,
+            which matters when the cache is stored in a remote session store.
+            :attr:`Format.ZLIB` returns bytes rather than a string.
+        """
+        if format not in (
+                self.Format.JSON, self.Format.COMPACT_JSON, self.Format.ZLIB):
+            raise ValueError("Unknown format: {}".format(format))
+        with self._lock:
+            version = self._next_version()
+            state = self._dump(format, version)
+            self._checkpoint(version)
+            return state
+
+    def _next_version(self):
+        return self.version + 1 if self._versioned and self.has_state_changed else (
+            self.version)
+
+    def _dump(self, format, version):  # Unlike serialize(), it makes no checkpoint
+        for credential_type in list(self._lazy):
+            self._materialize(credential_type)
+        if self._lazy_order:  # Restore the original order of top-level keys
+            ordered = {}
+            for key in self._lazy_order + list(self._cache):
+                if key in self._cache:
+                    ordered[key] = self._cache[key]
+            self._cache, self._lazy_order = ordered, []
+        if self._versioned:
+            self._cache[self.VERSION_KEY] = version
+        return self._encode(self._cache, format)
+
+    def _encode(self, obj, format):
+        if format == self.Format.JSON:
+            return json.dumps(obj, indent=4)
+        compact = self._dumps(obj)
+        if format == self.Format.ZLIB:
+            return zlib.compress(compact.encode("utf-8"))
+        return compact
+
+    def serialize_partition(self, home_account_id, format=Format.JSON):
+        # type: (str, str) -> Union[str, bytes]
+        """Serialize only the entries of one user, e.g. to be kept in a web session.
+
+        The output contains the tokens and account of that home_account_id,
+        plus the (usually few) app metadata,
+        so its size does not grow with the number of users in this cache.
+        It can be loaded by :func:`~deserialize` or :func:`~merge_partition`.
+        Unlike :func:`~serialize`, this does not reset :attr:`has_state_changed`.
+
+        :param str format: One of the :class:`SerializableTokenCache.Format`.
+        """
+        if format not in (
+                self.Format.JSON, self.Format.COMPACT_JSON, self.Format.ZLIB):
+            raise ValueError("Unknown format: {}".format(format))
+        partition = {}
+        with self._lock:
+            for credential_type in (
+                    self.CredentialType.ACCESS_TOKEN,
+                    self.CredentialType.REFRESH_TOKEN,
+                    self.CredentialType.ID_TOKEN,
+                    self.CredentialType.ACCOUNT):
+                self._materialize(credential_type)
+                entries = self._get_indexed_entries(credential_type)
+                keys = self._index.find(
+                    credential_type, {"home_account_id": home_account_id})
+                partition[credential_type] = {key: entries[key] for key in keys}
+            self._materialize(self.CredentialType.APP_METADATA)
+            partition[self.CredentialType.APP_METADATA] = dict(
+                self._cache.get(self.CredentialType.APP_METADATA, {}))
+            return self._encode(partition, format)
+
+    def merge_partition(self, state):
+        # type: (Union[str, bytes]) -> None
+        """Merge a state, typically from :func:`~serialize_partition`, into this cache.
+
+        Entries already in this cache are only replaced by newer ones,
+        per their ``last_modification_time`` (or ``cached_at``).
+        Other entries of this cache remain intact.
+        Merged entries count as changes, see :attr:`has_state_changed`.
+        """
+        with self._lock:
+            for credential_type, entries in self._loads(state).items():
+                if credential_type not in self.key_makers:
+                    continue  # Unknown top-level keys are not partitioned
+                self._materialize(credential_type)
+                for entry in entries.values():
+                    ours = self._cache.get(credential_type, {}).get(
+                        self.key_makers[credential_type](**entry))
+                    if ours is None or (
+                            _get_timestamp(entry) >= _get_timestamp(ours)):
+                        self.modify(credential_type, entry, entry)
+
+    def serialize_delta(self):
         # type: () -> str
-        """Serialize the current cache state into a string."""
+        """Serialize the entries added, modified or removed since last checkpoint.
+
+        A checkpoint is made by :func:`~serialize`, :func:`~deserialize`
+        or this method itself.
+
+        :return: A one-line string, suitable to be appended to a journal.
+        """
+        with self._lock:
+            delta = self._delta
+            self._checkpoint(self.version)
+            return self._dumps(delta)
+
+    def apply_delta(self, delta):
+        # type: (str) -> None
+        """Apply changes previously obtained by :func:`~serialize_delta`.
+
+        :param str delta:
+            One delta, or the content of a journal, i.e. multiple deltas
+            each in its own line. They will be applied in order.
+
+        Replaying a journal does not count as a state change.
+        """
         with self._lock:
-            self.has_state_changed = False
-            return json.dumps(self._cache, indent=4)
+            for line in delta.splitlines():
+                if not line.strip():
+                    continue
+                for credential_type, changes in self._loads(line).items():
+                    for key, entry in changes.items():
+                        self._put_entry(credential_type, key, entry)
+
+
+def _route(credential_type, query):
+    # Returns the only partition which could contain matches of this query,
+    # or None if the matches could span multiple partitions.
+    if credential_type == TokenCache.CredentialType.APP_METADATA:
+        return _get_partition({})  # App metadata has no user nor realm
+    if query.get("home_account_id") or (
+            "home_account_id" in query and "realm" in query):
+        return _get_partition(query)
+    return None
+
+
+class ShardedTokenCache(TokenCache):
+    """A token cache which partitions its entries into independent shards.
+
+    Entries of an end user are kept in the shard of that user's home_account_id,
+    and app-only tokens are kept in the shard of their realm (tenant).
+    Each shard has its own lock and storage,
+    so that the look-ups, writes and ``remove_account()`` of one user
+    would only touch one small shard, rather than contending for a global lock.
+    This is useful for a multi-tenant web API serving many users,
+    for example, via ``acquire_token_on_behalf_of()``.
+
+    A query not specifying a home_account_id (such as ``get_accounts()``)
+    would still visit all shards.
+
+    The entries of one token response span more than one shard,
+    which are saved one after another rather than atomically.
 
+    Like its base class, this class does not serialize/persist tokens.
+    """
+    def __init__(self, concurrent_reads=False):
+        """Create a sharded token cache.
+
+        :param bool concurrent_reads:
+            It will be applied to each shard.
+            See :func:`TokenCache.__init__` for details.
+        """
+        super(ShardedTokenCache, self).__init__()  # Its _lock guards _shards only
+        self._concurrent_reads = concurrent_reads
+        self._shards = {}  # {partition: TokenCache}
+
+    def _get_shard(self, partition):
+        shard = self._shards.get(partition)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(partition)
+                if shard is None:
+                    shard = TokenCache(concurrent_reads=self._concurrent_reads)
+                    shard.key_makers = self.key_makers  # Honor a customization
+                    shard._subscriptions = self._subscriptions  # Shared list
+                    self._shards[partition] = shard
+        return shard
+
+    def find(self, credential_type, target=None, query=None):
+        query = query or {}
+        partition = _route(credential_type, query)
+        if partition is not None:
+            shard = self._shards.get(partition)
+            return shard.find(credential_type, target=target, query=query
+                ) if shard else []
+        return [entry
+            for shard in list(self._shards.values())  # A snapshot of shards
+            for entry in shard.find(credential_type, target=target, query=query)]
+
+    def _save_entries(self, entries):
+        # Unlike its base class, this does NOT save the entries atomically.
+        # An event spans the shard of its user or realm and the shard of
+        # app metadata, which are saved one after another, each under its own
+        # lock. So readers may observe one shard updated before the other,
+        # and an exception in the middle would leave earlier shards saved.
+        # App metadata comes last in entries, and so does its shard here.
+        partitions = OrderedDict()
+        for credential_type, entry in entries:
+            partitions.setdefault(_get_partition(entry), []).append(
+                (credential_type, entry))
+        for partition, group in partitions.items():
+            with self._get_shard(partition)._lock:  # Only locks one shard
+                for credential_type, entry in group:
+                    self.modify(credential_type, entry, entry)
+
+    def compact(self, now=None):
+        # App metadata is kept in a shard of its own, apart from the tokens of
+        # its app, so whether an app is orphaned is checked across all shards.
+        now = time.time() if now is None else now
+        shards = list(self._shards.values())  # A snapshot of shards
+        removed, apps = 0, set()
+        for shard in shards:
+            with shard._lock:
+                removed += shard._remove_expired_access_tokens(now)
+                removed += shard._remove_orphaned_users()
+                apps.update(shard._orphaned_apps)
+                shard._orphaned_apps = set()
+        metadata_shard = self._shards.get(
+            _route(self.CredentialType.APP_METADATA, {}))
+        if metadata_shard and apps:
+            with metadata_shard._lock:  # An event saves its app metadata last
+                for environment, client_id in apps:
+                    if not any(shard._has_tokens_of_app(environment, client_id)
+                            for shard in list(self._shards.values())):
+                        removed += metadata_shard._remove_app_metadata(
+                            environment, client_id)
+        if removed:
+            logger.debug("Compaction removed %d entries", removed)
+        return removed
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        partition = _get_partition(old_entry)
+        if not new_key_value_pairs and partition not in self._shards:
+            return False  # Nothing to remove
+        return self._get_shard(partition).modify(
+            credential_type, old_entry, new_key_value_pairs)
@@ -0,0 +1,149 @@
+"""Micro benchmarks of TokenCache. They are not part of the unit test suite.
+
+Usage::
+
+    python -m tests.benchmark_token_cache
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from msal.token_cache import TokenCache, SerializableTokenCache
+from msal.persistence import MmapTokenCache, fcntl
+from msal.sqlite_token_cache import SqliteTokenCache
+from tests.test_token_cache import add_token, build_response
+
+
+def measure_concurrent_lookups(
+        cache, threads, duration=1, users=10000, writes_per_second=100,
+        write_latency=0):
+    """Returns how many find() calls per second are completed by all threads,
+    while another thread keeps writing into the cache at the given rate.
+
+    Each write holds the cache for at least write_latency seconds,
+    mimicking a synchronous subscriber which pushes changes to a remote store.
+    """
+    # Each thread checks the deadline by itself, because a main thread
+    # signalling them could oversleep when the readers hog the GIL
+    deadline = time.time() + duration
+    counts = [0] * threads
+
+    def reader(n):
+        i = n
+        while time.time() < deadline:
+            cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN, target=["s1"], query={
+                    "client_id": "my_client_id",
+                    "environment": "login.example.com",
+                    "realm": "contoso",
+                    "home_account_id": "uid%d.utid" % (i % users),
+                    })
+            counts[n] += 1
+            i += threads
+
+    def writer():
+        i = 0
+        while time.time() < deadline:
+            time.sleep(1.0 / writes_per_second)
+            add_token(cache, "uid%d" % (i % users), access_token="AT %d" % i)
+            i += 1
+
+    def replicate(event):  # Runs while the write holds the cache
+        time.sleep(write_latency)
+
+    if write_latency:
+        cache.subscribe(replicate)
+    workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+    workers.append(threading.Thread(target=writer))
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - deadline + duration
+    if write_latency:
+        cache.unsubscribe(replicate)
+    return sum(counts) / elapsed
+
+
+def build_events(count, client_id="my_client_id"):  # Mimic a migration of RTs
+    return [{
+        "client_id": client_id,
+        "scope": ["s1", "s2"],
+        "token_endpoint": "https://login.example.com/contoso/v2/token",
+        "response": build_response(
+            uid="uid%d" % i, utid="utid", access_token="AT %d" % i,
+            refresh_token="RT %d" % i),
+        } for i in range(count)]
+
+
+def measure_ingestion(cache, events, batch=False):
+    """Returns how many seconds it takes to add all events into the cache"""
+    start = time.time()
+    if batch:
+        cache.add_many(events)
+    else:
+        for event in events:
+            cache.add(event)
+    return time.time() - start
+
+
+def main(thread_counts=(1, 2, 4, 8, 16, 32), users=10000):
+    logging.disable(logging.CRITICAL)  # add() would otherwise log every event
+    caches = [TokenCache(), TokenCache(concurrent_reads=True)]
+    for cache in caches:
+        cache.add_many(build_events(users))
+    for write_latency in (0, 0.002):
+        print("Lookups per second, with %d users in cache, "
+            "and 100 writes per second each taking %s ms or more" % (
+                users, write_latency * 1000))
+        print("%8s %15s %18s" % ("threads", "RLock", "concurrent_reads"))
+        for threads in thread_counts:
+            print("%8d %15d %18d" % tuple([threads] + [
+                measure_concurrent_lookups(
+                    cache, threads, users=users, write_latency=write_latency)
+                for cache in caches]))
+        print("")
+
+    print("Seconds to ingest %d events" % users)
+    print("%-24s %10s %10s" % ("cache", "add()", "add_many()"))
+    for name, factory in [
+            ("TokenCache", TokenCache),
+            ("SerializableTokenCache", SerializableTokenCache),
+            ]:
+        print("%-24s %10.3f %10.3f" % tuple([name] + [
+            measure_ingestion(factory(), build_events(users), batch=batch)
+            for batch in (False, True)]))
+    logging.disable(logging.NOTSET)  # With a DEBUG logger, add() dumps each event
+    msal_logger = logging.getLogger("msal")
+    msal_logger.setLevel(logging.DEBUG)
+    msal_logger.propagate = False
+    msal_logger.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+    print("%-24s %10.3f %10.3f" % tuple(["TokenCache, DEBUG log"] + [
+        measure_ingestion(TokenCache(), build_events(users), batch=batch)
+        for batch in (False, True)]))
+    logging.disable(logging.CRITICAL)
+
+    events = users // 10  # Each add() of a persisted cache is a write to disk
+    print("\nSeconds to ingest %d events into a persisted cache" % events)
+    print("%-24s %10s %10s" % ("cache", "add()", "add_many()"))
+    folder = tempfile.mkdtemp()
+    try:
+        factories = [("SqliteTokenCache", SqliteTokenCache)]
+        if fcntl is not None:  # MmapTokenCache requires it
+            factories.append(("MmapTokenCache", MmapTokenCache))
+        for name, factory in factories:
+            print("%-24s %10.3f %10.3f" % tuple([name] + [
+                measure_ingestion(
+                    factory(os.path.join(folder, "%s-%s" % (name, batch))),
+                    build_events(events), batch=batch)
+                for batch in (False, True)]))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
+
@@ -1,6 +1,11 @@
 # Note: Since Aug 2019 we move all e2e tests into test_e2e.py,
 # so this test_application file contains only unit tests without dependency.
+import gc
+import shutil
 import sys
+import tempfile
+import threading
+import weakref
 from msal.application import *
 from msal.application import _str2bytes
 import msal
@@ -15,6 +20,29 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+def populate_cache(  # Mimic a token response obtained by a CachedTokenTestCase app
+        cache, client_id="my_app", scopes=("s1", "s2"),
+        authority_url="https://login.microsoftonline.com/my_tenant",
+        **kwargs  # Pass-through to build_response(): access_token, uid, utid, ...
+        ):
+    cache.add({
+        "client_id": client_id,
+        "scope": list(scopes),
+        "token_endpoint": "{}/oauth2/v2.0/token".format(authority_url),
+        "response": build_response(**kwargs),
+        })
+
+
+class CachedTokenTestCase(unittest.TestCase):
+    # Shared by test cases whose apps are served by a pre-populated cache
+    authority_url = "https://login.microsoftonline.com/my_tenant"
+    scopes = ["s1", "s2"]
+    uid = "my_uid"
+    utid = "my_utid"
+    account = {"home_account_id": "{}.{}".format(uid, utid)}
+    client_id = "my_app"
+
+
 class TestHelperExtractCerts(unittest.TestCase):  # It is used by SNI scenario
 
     def test_extract_a_tag_less_public_cert(self):
@@ -551,7 +579,7 @@ class TestTelemetryOnConfidentialClientApplication(unittest.TestCase):
     def test_acquire_token_for_client(self):
         at = "this is an access token"
         def mock_post(url, headers=None, *args, **kwargs):
-            self.assertEqual("4|730,0|", (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
+            self.assertEqual("4|730,2|", (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
             return MinimalResponse(status_code=200, text=json.dumps({"access_token": at}))
         result = self.app.acquire_token_for_client(["scope"], post=mock_post)
         self.assertEqual(at, result.get("access_token"))
@@ -559,12 +587,483 @@ class TestTelemetryOnConfidentialClientApplication(unittest.TestCase):
     def test_acquire_token_on_behalf_of(self):
         at = "this is an access token"
         def mock_post(url, headers=None, *args, **kwargs):
-            self.assertEqual("4|523,0|", (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
+            self.assertEqual("4|523,2|", (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
             return MinimalResponse(status_code=200, text=json.dumps({"access_token": at}))
         result = self.app.acquire_token_on_behalf_of("assertion", ["s"], post=mock_post)
         self.assertEqual(at, result.get("access_token"))
 
 
+class TestAcquireTokenForClientFromCache(CachedTokenTestCase):
+
+    def setUp(self):
+        self.app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url)
+
+    def populate_cache(self, access_token="at", expires_in=86400, **kwargs):
+        populate_cache(
+            self.app.token_cache,
+            access_token=access_token, expires_in=expires_in, **kwargs)
+
+    def mock_post(self, access_token=None, telemetry=None, status_code=200):
+        def mock_post(url, headers=None, *args, **kwargs):
+            if telemetry:
+                self.assertEqual(
+                    telemetry, (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
+            return MinimalResponse(status_code=status_code, text=json.dumps(
+                {"access_token": access_token} if access_token
+                else {"error": "something went wrong"}))
+        return mock_post
+
+    def test_token_obtained_should_be_returned_from_cache_next_time(self):
+        result = self.app.acquire_token_for_client(
+            self.scopes, post=self.mock_post(access_token="an AT"))
+        self.assertEqual("an AT", result.get("access_token"))
+        result = self.app.acquire_token_for_client(
+            ["s1"],  # A subset of the cached scopes is still a hit
+            post=lambda url, *args, **kwargs:  # Utilize the undocumented test feature
+                self.fail("I/O shouldn't happen in cache hit AT scenario"))
+        self.assertEqual("an AT", result.get("access_token"))
+
+    def test_token_of_another_tenant_should_not_be_returned(self):
+        self.populate_cache(access_token="old AT")
+        app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority="https://login.microsoftonline.com/another_tenant",
+            token_cache=self.app.token_cache)
+        result = app.acquire_token_for_client(
+            self.scopes, post=self.mock_post(access_token="new AT"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def test_token_expiring_soon_should_be_refreshed(self):
+        self.populate_cache(access_token="old AT", expires_in=5*60-10)
+        result = self.app.acquire_token_for_client(self.scopes, post=self.mock_post(
+            access_token="new AT", telemetry="4|730,3|"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def test_aging_token_should_be_refreshed(self):
+        self.populate_cache(access_token="old AT", refresh_in=-1)
+        result = self.app.acquire_token_for_client(self.scopes, post=self.mock_post(
+            access_token="new AT", telemetry="4|730,4|"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def test_aging_token_should_be_returned_when_refresh_fails(self):
+        self.populate_cache(access_token="old AT", refresh_in=-1)
+        result = self.app.acquire_token_for_client(
+            self.scopes, post=self.mock_post(status_code=500))
+        self.assertEqual("old AT", result.get("access_token"))
+
+    def test_force_refresh_should_bypass_cache(self):
+        self.populate_cache(access_token="old AT")
+        result = self.app.acquire_token_for_client(
+            self.scopes, force_refresh=True,
+            post=self.mock_post(access_token="new AT", telemetry="4|730,1|"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+
+class TestAcquireTokenOnBehalfOfFromCache(unittest.TestCase):
+    authority_url = "https://login.microsoftonline.com/my_tenant"
+    scopes = ["s1", "s2"]
+    assertion = "header.payload.signature"
+
+    def setUp(self):
+        self.app = ConfidentialClientApplication(
+            "my_app", client_credential="secret", authority=self.authority_url)
+
+    def mock_post(self, grant_type, access_token="an AT", expires_in=3600):
+        def mock_post(url, headers=None, data=None, *args, **kwargs):
+            self.assertEqual(grant_type, (data or {}).get("grant_type"))
+            return MinimalResponse(status_code=200, text=json.dumps(build_response(
+                uid="uid", utid="utid", access_token=access_token,
+                expires_in=expires_in, refresh_token="an RT")))
+        return mock_post
+
+    def test_same_assertion_should_be_served_from_cache(self):
+        result = self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=self.mock_post(self.app.client.GRANT_TYPE_JWT))
+        self.assertEqual("an AT", result.get("access_token"))
+        result = self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=lambda url, *args, **kwargs:  # Utilize the undocumented test feature
+                self.fail("I/O shouldn't happen in cache hit AT scenario"))
+        self.assertEqual("an AT", result.get("access_token"))
+        self.assertNotIn(
+            self.assertion, json.dumps(self.app.token_cache._cache),
+            "The user assertion itself shall not be cached")
+
+    def test_another_assertion_should_not_hit_cache(self):
+        self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=self.mock_post(self.app.client.GRANT_TYPE_JWT))
+        result = self.app.acquire_token_on_behalf_of(
+            "another assertion", self.scopes, post=self.mock_post(
+                self.app.client.GRANT_TYPE_JWT, access_token="another AT"))
+        self.assertEqual("another AT", result.get("access_token"))
+
+    def test_expired_at_should_be_refreshed_by_obo_rt(self):
+        self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=self.mock_post(self.app.client.GRANT_TYPE_JWT, expires_in=60))
+        result = self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=self.mock_post("refresh_token", access_token="new AT"))
+        self.assertEqual("new AT", result.get("access_token"))
+        result = self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=lambda url, *args, **kwargs:  # Utilize the undocumented test feature
+                self.fail("The refreshed AT shall remain bound to the assertion"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def test_force_refresh_should_redeem_assertion_again(self):
+        self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes,
+            post=self.mock_post(self.app.client.GRANT_TYPE_JWT))
+        result = self.app.acquire_token_on_behalf_of(
+            self.assertion, self.scopes, force_refresh=True, post=self.mock_post(
+                self.app.client.GRANT_TYPE_JWT, access_token="new AT"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+
+class TestRefreshAhead(CachedTokenTestCase):
+    expires_in = 5*60 + ClientApplication._REFRESH_AHEAD_LEAD + 1  # Due in 1 second
+
+    def assert_refreshed_ahead(self, acquire, new_response):
+        self.addCleanup(self.app.close)
+        refreshed = threading.Event()
+        self.app.token_cache.subscribe(lambda event: refreshed.set()
+            if (event["new"] or {}).get("secret") == "new AT" else None)
+        result = acquire(post=lambda url, *args, **kwargs: MinimalResponse(
+            status_code=200, text=json.dumps(new_response)))
+        self.assertEqual("old AT", result.get("access_token"), "Cache hit")
+        self.assertTrue(refreshed.wait(5), "It should be refreshed in background")
+        result = acquire(
+            post=lambda url, *args, **kwargs:  # Utilize the undocumented test feature
+                self.fail("I/O shouldn't happen after refresh ahead"))
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def test_user_token_being_used_should_be_refreshed_ahead(self):
+        self.app = ClientApplication(
+            self.client_id, authority=self.authority_url, refresh_ahead_workers=1)
+        populate_cache(
+            self.app.token_cache, access_token="old AT", expires_in=self.expires_in,
+            uid=self.uid, utid=self.utid, refresh_token="an RT")
+        self.assert_refreshed_ahead(
+            lambda **kwargs: self.app.acquire_token_silent(
+                self.scopes, self.account, **kwargs),
+            build_response(
+                access_token="new AT", uid=self.uid, utid=self.utid,
+                refresh_token="new RT", scope=" ".join(self.scopes)))
+
+    def test_app_token_being_used_should_be_refreshed_ahead(self):
+        self.app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, refresh_ahead_workers=1)
+        populate_cache(
+            self.app.token_cache, access_token="old AT", expires_in=self.expires_in)
+        self.assert_refreshed_ahead(
+            lambda **kwargs: self.app.acquire_token_for_client(self.scopes, **kwargs),
+            {"access_token": "new AT", "expires_in": 3600})
+
+    def _hit_token_in_cache(self, app):
+        populate_cache(app.token_cache, access_token="old AT")
+        result = app.acquire_token_for_client(self.scopes)
+        self.assertEqual("old AT", result.get("access_token"), "Cache hit")
+
+    def test_closing_app_should_stop_its_threads(self):
+        with ConfidentialClientApplication(
+                self.client_id, client_credential="secret",
+                authority=self.authority_url, refresh_ahead_workers=2) as app:
+            self._hit_token_in_cache(app)
+            threads = list(app._refresh_ahead._threads)
+            self.assertEqual(3, len(threads), "1 dispatcher and 2 workers")
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self._hit_token_in_cache(app)  # A closed app remains usable
+        self.assertEqual({}, app._refresh_ahead_jobs, "But it tracks no refresh")
+
+    def test_failed_refresh_ahead_should_be_retried_after_a_backoff(self):
+        self.app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, refresh_ahead_workers=1)
+        self.addCleanup(self.app.close)
+        populate_cache(
+            self.app.token_cache, access_token="old AT",
+            expires_in=self.expires_in - 10)  # Due already
+        requests = []
+        def mock_post(url, *args, **kwargs):
+            requests.append(url)
+            return MinimalResponse(status_code=400, text=json.dumps({
+                "error": "invalid_client"}))
+        self.app.acquire_token_for_client(self.scopes, post=mock_post)
+        for _ in range(50):  # Wait for the refresh ahead to fail
+            if self.app._refresh_ahead_failures:
+                break
+            time.sleep(0.1)
+        for _ in range(5):
+            result = self.app.acquire_token_for_client(self.scopes, post=mock_post)
+            self.assertEqual("old AT", result.get("access_token"), "Cache hit")
+        time.sleep(0.5)
+        self.assertEqual(1, len(requests), "Hits shall not retry it right away")
+
+    def test_discarded_app_should_be_collected_and_stop_its_threads(self):
+        app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, refresh_ahead_workers=1)
+        self._hit_token_in_cache(app)  # So a refresh is being tracked
+        threads = list(app._refresh_ahead._threads)
+        app_ref = weakref.ref(app)
+        del app
+        gc.collect()
+        self.assertIsNone(app_ref(), "Tracked refresh shall not keep app alive")
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+
+class TestCoalescedRefresh(CachedTokenTestCase):
+
+    def test_concurrent_refreshes_of_same_token_should_be_coalesced(self):
+        app, results, requests = self.refresh_concurrently([False] * 5)
+        self.assertEqual(["new AT"] * 5, [r.get("access_token") for r in results])
+        self.assertEqual(1, len(requests), "Only one RT redemption should happen")
+        metrics = app.get_coalesced_refresh_metrics()
+        self.assertEqual(1, metrics["executed"])
+        self.assertEqual(4, metrics["coalesced"])
+
+    def test_forced_refresh_should_not_be_coalesced_with_unforced_one(self):
+        app, results, requests = self.refresh_concurrently([False, True, True])
+        self.assertEqual(2, len(requests), "One per kind of refresh")
+
+    def refresh_concurrently(self, force_refresh_per_thread):
+        # Returns the app, the results of all threads, and the requests made
+        app = ClientApplication(self.client_id, authority=self.authority_url)
+        populate_cache(
+            app.token_cache, access_token="expired AT", expires_in=-1,
+            uid=self.uid, utid=self.utid, refresh_token="an RT")
+        requests = []
+        def mock_post(url, *args, **kwargs):
+            requests.append(url)
+            time.sleep(0.3)  # Long enough for other threads to arrive
+            return MinimalResponse(status_code=200, text=json.dumps(build_response(
+                access_token="new AT", uid=self.uid, utid=self.utid,
+                refresh_token="rotated RT")))
+        results = []
+        threads = [
+            threading.Thread(target=lambda force=force: results.append(
+                app.acquire_token_silent(
+                    self.scopes, self.account, force_refresh=force,
+                    post=mock_post)))
+            for force in force_refresh_per_thread]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return app, results, requests
+
+
+class TestRefreshLease(CachedTokenTestCase):
+
+    def test_only_one_process_should_redeem_rt(self):
+        lease_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lease_dir)
+        cache = msal.SerializableTokenCache()  # Mimic a cache shared by processes
+        populate_cache(
+            cache, access_token="expired AT", expires_in=-1,
+            uid=self.uid, utid=self.utid, refresh_token="an RT")
+        # Each app mimics a process, which does not share in-process coalescing
+        apps = [
+            ClientApplication(
+                self.client_id, authority=self.authority_url,
+                token_cache=cache, refresh_lease_dir=lease_dir)
+            for _ in range(3)]
+        requests = []
+        def mock_post(url, *args, **kwargs):
+            requests.append(url)
+            time.sleep(0.3)  # Long enough for other processes to arrive
+            return MinimalResponse(status_code=200, text=json.dumps(build_response(
+                access_token="new AT", uid=self.uid, utid=self.utid,
+                refresh_token="rotated RT", scope=" ".join(self.scopes))))
+        results = []
+        threads = [
+            threading.Thread(target=lambda app=app: results.append(
+                app.acquire_token_silent(self.scopes, self.account, post=mock_post)))
+            for app in apps]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(["new AT"] * 3, [r.get("access_token") for r in results])
+        self.assertEqual(1, len(requests), "Only one RT redemption should happen")
+        self.assertEqual([], os.listdir(lease_dir), "Lease should be released")
+
+
+class TestJitteredRefresh(CachedTokenTestCase):
+
+    def test_refresh_before_expiry_should_be_configurable(self):
+        app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, refresh_before_expiry=15*60)
+        populate_cache(app.token_cache, access_token="old AT", expires_in=10*60)
+        def mock_post(url, headers=None, *args, **kwargs):
+            self.assertEqual("4|730,3|", (headers or {}).get(CLIENT_CURRENT_TELEMETRY))
+            return MinimalResponse(status_code=200, text=json.dumps(
+                {"access_token": "new AT", "expires_in": 3600}))
+        result = app.acquire_token_for_client(self.scopes, post=mock_post)
+        self.assertEqual("new AT", result.get("access_token"))
+
+    def simulate_fleet(self, size, **kwargs):
+        # Every replica obtained its token at deployment. Returns when each of
+        # them would start refreshing it, in seconds after deployment.
+        deployed_at = 1000000000
+        entry = {
+            "credential_type": "AccessToken",
+            "environment": "login.microsoftonline.com",
+            "client_id": self.client_id,
+            "realm": "my_tenant",
+            "target": " ".join(self.scopes),
+            "expires_on": str(deployed_at + 3600),
+            "refresh_on": str(deployed_at + 1800),
+            }
+        fleet = [
+            ConfidentialClientApplication(
+                self.client_id, client_credential="secret",
+                authority=self.authority_url, **kwargs)
+            for _ in range(size)]
+        for app in fleet:
+            self.assertEqual(
+                app._get_refresh_times(entry), app._get_refresh_times(entry),
+                "Jitter shall be deterministic per instance")
+        return sorted(
+            app._get_refresh_times(entry)[0] - deployed_at for app in fleet)
+
+    def test_fleet_without_jitter_should_refresh_at_same_moment(self):
+        self.assertEqual(
+            1, len(set(self.simulate_fleet(50))),
+            "This is the refresh storm that jitter is meant to solve")
+
+    def test_fleet_with_jitter_should_spread_refresh_load(self):
+        jitter = 10*60
+        moments = self.simulate_fleet(50, refresh_jitter=jitter)
+        self.assertTrue(all(1800 - jitter <= m <= 1800 for m in moments),
+            "Refresh shall only happen earlier, within the jitter window")
+        self.assertGreater(moments[-1] - moments[0], jitter / 2)
+        per_minute = {}
+        for m in moments:
+            per_minute[int(m // 60)] = per_minute.get(int(m // 60), 0) + 1
+        self.assertLessEqual(
+            max(per_minute.values()), 50 // 3,
+            "The load in any minute shall be a fraction of the fleet")
+
+    def test_jitter_should_never_serve_a_token_later(self):
+        app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, refresh_jitter=10*60)
+        populate_cache(app.token_cache, access_token="old AT", expires_in=5*60 - 1)
+        result = app.acquire_token_for_client(
+            self.scopes, post=lambda url, *args, **kwargs: MinimalResponse(
+                status_code=200, text=json.dumps({"access_token": "new AT"})))
+        self.assertEqual("new AT", result.get("access_token"))
+
+
+class TestServeStaleTokens(CachedTokenTestCase):
+
+    def build_app(
+            self, serve_stale_tokens=True, expires_in=-1, ext_expires_in=3600,
+            token_cache=None):
+        app = ConfidentialClientApplication(
+            self.client_id, client_credential="secret",
+            authority=self.authority_url, serve_stale_tokens=serve_stale_tokens,
+            token_cache=token_cache)
+        populate_cache(
+            app.token_cache, access_token="stale AT",
+            expires_in=expires_in, ext_expires_in=ext_expires_in)
+        return app
+
+    def outage(self, status_code=503, text="Service Unavailable"):
+        return lambda url, *args, **kwargs: MinimalResponse(
+            status_code=status_code, text=text)
+
+    def test_stale_token_should_be_served_during_outage(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage())
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+        self.assertGreater(result["expires_in"], 3500, "Extended lifetime remains")
+
+    def test_stale_token_should_be_served_when_sts_returns_an_error_in_5xx(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage(
+            status_code=503, text=json.dumps({"error": "temporarily_unavailable"})))
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+
+    def test_stale_token_should_be_served_when_sts_is_throttling(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage(
+            status_code=429, text=json.dumps({"error": "server_error"})))
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+
+    def test_stale_token_should_be_served_when_sts_is_unreachable(self):
+        def unreachable(url, *args, **kwargs):
+            raise IOError("Connection refused")
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=unreachable)
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+
+    def test_stale_token_should_not_be_served_for_invalid_grant(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage(
+            status_code=400, text=json.dumps({"error": "invalid_grant"})))
+        self.assertEqual("invalid_grant", result.get("error"))
+        self.assertNotIn("access_token", result)
+
+    def test_stale_token_should_not_be_served_for_an_unavailable_error_in_4xx(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage(
+            status_code=400, text=json.dumps({"error": "temporarily_unavailable"})))
+        self.assertEqual("temporarily_unavailable", result.get("error"))
+
+    def test_stale_token_should_survive_compaction_and_be_served_during_outage(self):
+        cache = TokenCache(compact_interval=0.001)
+        app = self.build_app(token_cache=cache)
+        time.sleep(0.01)
+        populate_cache(  # An unrelated write, which triggers a compaction
+            cache, client_id="another_app", access_token="another AT")
+        self.assertEqual(0, cache.compact(), "Compaction should have been done")
+        result = app.acquire_token_for_client(self.scopes, post=self.outage())
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+
+    def test_stale_token_should_not_be_served_for_other_errors(self):
+        app = self.build_app()
+        result = app.acquire_token_for_client(self.scopes, post=self.outage(
+            status_code=400, text=json.dumps({"error": "invalid_client"})))
+        self.assertEqual("invalid_client", result.get("error"))
+
+    def test_stale_token_should_not_be_served_beyond_extended_lifetime(self):
+        app = self.build_app(ext_expires_in=-1)
+        with self.assertRaises(ValueError):  # The non-JSON response bubbles up
+            app.acquire_token_for_client(self.scopes, post=self.outage())
+
+    def test_stale_token_should_not_be_served_by_default(self):
+        app = self.build_app(serve_stale_tokens=False)
+        with self.assertRaises(ValueError):
+            app.acquire_token_for_client(self.scopes, post=self.outage())
+
+    def test_stale_user_token_should_be_served_during_outage(self):
+        app = ClientApplication(
+            self.client_id, authority=self.authority_url, serve_stale_tokens=True)
+        populate_cache(
+            app.token_cache, access_token="stale AT", expires_in=-1,
+            ext_expires_in=3600, uid=self.uid, utid=self.utid, refresh_token="an RT")
+        result = app.acquire_token_silent(
+            self.scopes, self.account, post=self.outage())
+        self.assertEqual("stale AT", result.get("access_token"))
+        self.assertTrue(result.get("stale"))
+
+
 class TestClientApplicationWillGroupAccounts(unittest.TestCase):
     def test_get_accounts(self):
         client_id = "my_app"
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from msal.concurrency import _FileLease as FileLease
+from msal.concurrency import _RefreshAheadScheduler as RefreshAheadScheduler
+from msal.concurrency import _SingleFlight as SingleFlight
+from tests import unittest
+
+
+class TestRefreshAheadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = RefreshAheadScheduler(workers=2)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_refreshes_should_run_in_due_order(self):
+        done = threading.Event()
+        order = []
+        now = time.time()
+        self.scheduler = RefreshAheadScheduler(workers=1)
+        self.scheduler.track("b", lambda: order.append("b"), now + 0.2)
+        self.scheduler.track("a", lambda: order.append("a"), now + 0.1)
+        self.scheduler.track("c", done.set, now + 0.3)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(["a", "b"], order)
+
+    def test_rescheduled_refresh_should_run_once_at_new_due(self):
+        done = threading.Event()
+        calls = []
+        def refresh():
+            calls.append(time.time())
+            done.set()
+        now = time.time()
+        self.scheduler.track("key", refresh, now + 0.1)
+        self.scheduler.track("key", refresh, now + 0.3)  # Hit again, renewed due
+        self.assertTrue(done.wait(5))
+        time.sleep(0.3)
+        self.assertEqual(1, len(calls))
+        self.assertGreaterEqual(calls[0], now + 0.3)
+
+    def test_concurrent_refreshes_should_be_bounded_by_workers(self):
+        release = threading.Event()
+        lock = threading.Lock()
+        running = [0, 0]  # [current, peak]
+        def refresh():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+        for i in range(5):
+            self.scheduler.track(i, refresh, 0)  # Already due
+        time.sleep(0.3)
+        release.set()
+        self.scheduler.close()  # It waits for the running refreshes
+        self.assertEqual(2, running[1])
+
+    def test_failed_refresh_should_not_stop_the_worker(self):
+        done = threading.Event()
+        def fail():
+            raise IOError("Network is down")
+        self.scheduler = RefreshAheadScheduler(workers=1)
+        self.scheduler.track("bad", fail, 0)
+        self.scheduler.track("good", done.set, 0)
+        self.assertTrue(done.wait(5))
+
+    def test_closed_scheduler_should_track_nothing(self):
+        self.scheduler = RefreshAheadScheduler(workers=1)
+        self.assertTrue(self.scheduler.track("key", lambda: None, time.time() + 60))
+        self.scheduler.close()
+        self.assertFalse(self.scheduler.track("key", lambda: None, 0))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+
+    def run_concurrently(self, function, key="key", count=5):
+        outcomes = []
+        def call():
+            try:
+                outcomes.append(self.single_flight.do(key, function))
+            except Exception as e:
+                outcomes.append(e)
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return outcomes
+
+    def slow(self, outcome):
+        calls = []
+        def function():
+            calls.append(1)
+            time.sleep(0.3)  # Long enough for other threads to arrive
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return function, calls
+
+    def test_concurrent_calls_should_share_one_execution(self):
+        function, calls = self.slow("result")
+        self.assertEqual(["result"] * 5, self.run_concurrently(function))
+        self.assertEqual(1, len(calls))
+        metrics = self.single_flight.get_metrics()
+        self.assertEqual(1, metrics["executed"])
+        self.assertEqual(4, metrics["coalesced"])
+        self.assertGreater(metrics["max_wait_seconds"], 0)
+        self.assertGreaterEqual(metrics["wait_seconds"], metrics["max_wait_seconds"])
+
+    def test_concurrent_calls_should_share_one_exception(self):
+        error = IOError("Network is down")
+        function, calls = self.slow(error)
+        self.assertEqual([error] * 5, self.run_concurrently(function))
+        self.assertEqual(1, len(calls))
+
+    def test_subsequent_call_should_execute_again(self):
+        function, calls = self.slow("result")
+        self.single_flight.do("key", function)
+        self.single_flight.do("key", function)
+        self.assertEqual(2, len(calls))
+
+    def test_different_keys_should_not_be_coalesced(self):
+        function, calls = self.slow("result")
+        t = threading.Thread(target=self.single_flight.do, args=("a", function))
+        t.start()
+        self.single_flight.do("b", function)
+        t.join()
+        self.assertEqual(2, len(calls))
+
+
+class TestFileLease(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "my.lease")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_lease_should_be_exclusive_until_released(self):
+        mine, theirs = FileLease(self.path), FileLease(self.path)
+        self.assertTrue(mine.acquire())
+        self.assertFalse(theirs.acquire())
+        mine.release()
+        self.assertTrue(theirs.acquire())
+        theirs.release()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_expired_lease_should_be_taken_over(self):
+        crashed, theirs = FileLease(self.path, ttl=30), FileLease(self.path, ttl=30)
+        self.assertTrue(crashed.acquire())
+        an_hour_ago = time.time() - 3600
+        os.utime(self.path, (an_hour_ago, an_hour_ago))
+        self.assertTrue(theirs.acquire())
+        crashed.release()  # It comes back too late
+        self.assertTrue(os.path.exists(self.path), "Their lease shall remain")
+        theirs.release()
+        self.assertFalse(os.path.exists(self.path))
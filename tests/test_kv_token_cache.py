@@ -0,0 +1,84 @@
+from msal.token_cache import TokenCache
+from msal.kv_token_cache import (
+    InMemoryStore, KeyValueTokenCache, SocketStore, serve_store)
+from tests import unittest
+from tests.test_token_cache import add_token
+
+
+class ScanCountingStore(InMemoryStore):
+    def __init__(self):
+        super(ScanCountingStore, self).__init__()
+        self.scanned = []
+
+    def scan(self, partition, credential_type):
+        self.scanned.append(partition)
+        return super(ScanCountingStore, self).scan(partition, credential_type)
+
+
+class KeyValueTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ScanCountingStore()
+        self.cache = KeyValueTokenCache(self.store)
+        self.another_cache = KeyValueTokenCache(self.store)
+
+    def _add(self, cache, uid=None, **kwargs):
+        add_token(
+            cache, uid, scope=["s1", "s2"],
+            access_token="AT of %s" % (uid or "app"), **kwargs)
+
+    def test_entries_should_be_stored_per_partition(self):
+        self._add(self.cache, "alice", refresh_token="RT of alice")
+        self._add(self.cache, "bob")
+        self._add(self.cache)  # An app-only token
+        self.assertEqual(
+            set(["home_account_id:alice.utid", "home_account_id:bob.utid",
+                "realm:contoso", "realm:"]),
+            set(self.store.partitions()))
+
+        del self.store.scanned[:]
+        self.assertEqual(["AT of bob"], [at["secret"] for at in self.cache.find(
+            TokenCache.CredentialType.ACCESS_TOKEN, target=["s2"],
+            query={"home_account_id": "bob.utid", "client_id": "my_client_id"})])
+        self.assertEqual(["home_account_id:bob.utid"], self.store.scanned)
+
+        self.assertEqual(
+            ["AT of alice", "AT of app", "AT of bob"],
+            sorted(at["secret"] for at in self.cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN, target=["s1"])))
+        self.assertEqual([], self.cache.find(
+            TokenCache.CredentialType.ACCESS_TOKEN, target=["s3"]))
+
+    def test_changes_should_be_visible_to_caches_sharing_the_store(self):
+        self._add(self.cache, "alice", refresh_token="RT of alice")
+        rt = self.another_cache.find(
+            TokenCache.CredentialType.REFRESH_TOKEN,
+            query={"home_account_id": "alice.utid"})[0]
+        self.assertTrue(self.another_cache.update_rt(rt, "new RT"))
+        self.assertEqual(["new RT"], [rt["secret"] for rt in self.cache.find(
+            TokenCache.CredentialType.REFRESH_TOKEN)])
+        for account in self.cache.find(TokenCache.CredentialType.ACCOUNT):
+            self.cache.remove_account(account)
+        self.assertEqual([], self.another_cache.find(
+            TokenCache.CredentialType.ACCOUNT))
+        self.assertFalse(self.cache.remove_account(account), "Already removed")
+
+
+class SocketStoreTestCase(KeyValueTokenCacheTestCase):
+    # Run all inherited test methods, with each cache talking to a local server
+
+    def setUp(self):
+        self.store = ScanCountingStore()
+        self.server = serve_store(self.store)
+        self.cache = KeyValueTokenCache(SocketStore(self.server.server_address))
+        self.another_cache = KeyValueTokenCache(
+            SocketStore(self.server.server_address))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_errors_should_be_relayed(self):
+        with self.assertRaises(RuntimeError):
+            SocketStore(self.server.server_address)._call("no_such_method")
+
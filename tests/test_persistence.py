@@ -0,0 +1,206 @@
+import multiprocessing
+import os
+import json
+import shutil
+import tempfile
+import time
+
+from msal.token_cache import TokenCache, SerializableTokenCache
+from msal.persistence import (
+    MmapTokenCache, WriteBehindPersister, save_with_merge, fcntl)
+from tests import unittest
+from tests.test_token_cache import add_token, build_response
+
+
+def _add_tokens(path, worker, count, cache=None):
+    cache = cache or MmapTokenCache(path)
+    for i in range(count):
+        add_token(
+            cache, "uid{}-{}".format(worker, i), now=None,
+            access_token="an access token", refresh_token="a refresh token")
+
+
+def _save_tokens_with_merge(path, worker, count):
+    cache = SerializableTokenCache(versioned=True)
+    for i in range(count):
+        _add_tokens(path, "{}-{}".format(worker, i), 1, cache=cache)
+        if not save_with_merge(cache, path, retries=0):
+            raise RuntimeError("The file was rewritten during our save")
+
+
+@unittest.skipIf(fcntl is None, "fcntl is unavailable on this platform")
+class MmapTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "token_cache.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_changes_should_be_visible_to_another_instance(self):
+        writer, reader = MmapTokenCache(self.path), MmapTokenCache(self.path)
+        self.assertEqual([], reader.find(TokenCache.CredentialType.ACCESS_TOKEN))
+        _add_tokens(self.path, "a", 1)
+        at = reader.find(TokenCache.CredentialType.ACCESS_TOKEN)[0]
+        self.assertEqual("uida-0.utid", at["home_account_id"])
+        reader.remove_at(at)
+        self.assertEqual([], writer.find(TokenCache.CredentialType.ACCESS_TOKEN))
+        self.assertEqual(
+            1, len(writer.find(TokenCache.CredentialType.REFRESH_TOKEN)))
+
+    def test_reader_should_not_reload_an_unchanged_file(self):
+        _add_tokens(self.path, "a", 1)
+        reader = MmapTokenCache(self.path)
+        reader.find(TokenCache.CredentialType.ACCESS_TOKEN)
+        mapping = reader._mapping
+        self.assertIsNotNone(mapping)
+        reader.find(TokenCache.CredentialType.REFRESH_TOKEN)
+        self.assertIs(mapping, reader._mapping, "Should not have reloaded")
+        _add_tokens(self.path, "b", 1)
+        self.assertEqual(
+            2, len(reader.find(TokenCache.CredentialType.ACCESS_TOKEN)))
+        self.assertIsNot(mapping, reader._mapping, "Should have reloaded")
+
+    def test_add_many_should_write_the_file_only_once(self):
+        _add_tokens(self.path, "a", 1)
+        cache = MmapTokenCache(self.path)
+        cache.find(TokenCache.CredentialType.ACCESS_TOKEN)
+        cache.add_many([{
+            "client_id": "my_client_id",
+            "scope": ["s1"],
+            "token_endpoint": "https://login.example.com/contoso/v2/token",
+            "response": build_response(
+                uid="uid%d" % i, utid="utid", access_token="an access token"),
+            } for i in range(10)])
+        self.assertEqual(2, cache._version)
+        self.assertEqual(11, len(MmapTokenCache(self.path).find(
+            TokenCache.CredentialType.ACCESS_TOKEN)))
+
+    def test_a_foreign_file_should_be_rejected(self):
+        with open(self.path, "w") as f:
+            f.write("{}")
+        with self.assertRaises(ValueError):
+            MmapTokenCache(self.path).find(TokenCache.CredentialType.ACCESS_TOKEN)
+
+    def test_concurrent_writers_in_different_processes_should_not_lose_changes(self):
+        workers = [
+            multiprocessing.Process(target=_add_tokens, args=(self.path, n, 5))
+            for n in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(
+            20, len(MmapTokenCache(self.path).find(
+                TokenCache.CredentialType.ACCESS_TOKEN)))
+
+
+class WriteBehindPersisterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "token_cache.json")
+        self.cache = SerializableTokenCache()
+        self.writes = []
+        self.persister = WriteBehindPersister(self.cache, self.path, max_delay=0.2)
+        original_flush = self.persister.flush
+        def flush():
+            if self.cache.has_state_changed:
+                self.writes.append(time.time())
+            original_flush()
+        self.persister.flush = flush
+
+    def tearDown(self):
+        self.persister.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _load_ats(self):
+        with open(self.path) as f:
+            return json.load(f)["AccessToken"]
+
+    def test_a_burst_of_changes_should_be_written_once_within_max_delay(self):
+        _add_tokens(self.path, "a", 10, cache=self.cache)
+        self.assertFalse(os.path.exists(self.path), "Not written on request path")
+        time.sleep(0.6)
+        self.assertEqual(1, len(self.writes))
+        self.assertEqual(10, len(self._load_ats()))
+        time.sleep(0.3)
+        self.assertEqual(1, len(self.writes), "No more write without change")
+
+    def test_close_should_flush_pending_changes_and_be_reloadable(self):
+        _add_tokens(self.path, "a", 1, cache=self.cache)
+        self.persister.close()
+        self.assertEqual(1, len(self._load_ats()))
+        another = SerializableTokenCache()
+        WriteBehindPersister(another, self.path).close()
+        self.assertEqual(
+            1, len(another.find(TokenCache.CredentialType.ACCESS_TOKEN)))
+
+
+class SaveWithMergeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "token_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _load(self, cache_class=SerializableTokenCache):
+        cache = cache_class(versioned=True)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                cache.deserialize(f.read())
+        return cache
+
+    def _home_account_ids(self):
+        return sorted(at["home_account_id"] for at in self._load().find(
+            TokenCache.CredentialType.ACCESS_TOKEN))
+
+    def test_updates_from_different_processes_should_all_be_saved(self):
+        worker1, worker2 = self._load(), self._load()
+        _add_tokens(self.path, "a", 1, cache=worker1)
+        _add_tokens(self.path, "b", 1, cache=worker2)
+        self.assertTrue(save_with_merge(worker1, self.path))
+        self.assertTrue(save_with_merge(worker2, self.path))
+        self.assertEqual(["uida-0.utid", "uidb-0.utid"], self._home_account_ids())
+        self.assertEqual(2, worker2.version)
+        self.assertTrue(save_with_merge(worker2, self.path), "Nothing to save")
+        self.assertEqual(2, self._load().version)
+
+    def test_it_should_retry_when_file_was_rewritten_during_the_save(self):
+        path = self.path
+        class InterruptedCache(SerializableTokenCache):
+            interrupted = False
+            def _dump(self, *args, **kwargs):
+                if not self.interrupted:  # A process not taking the lock sneaks in
+                    InterruptedCache.interrupted = True
+                    another = SerializableTokenCache(versioned=True)
+                    _add_tokens(path, "b", 1, cache=another)
+                    with open(path, "w") as f:
+                        f.write(another.serialize())
+                return super(InterruptedCache, self)._dump(*args, **kwargs)
+        cache = self._load(InterruptedCache)
+        _add_tokens(self.path, "a", 1, cache=cache)
+        self.assertTrue(save_with_merge(cache, self.path))
+        self.assertEqual(["uida-0.utid", "uidb-0.utid"], self._home_account_ids())
+        self.assertEqual(2, cache.version)
+
+    @unittest.skipIf(fcntl is None, "fcntl is unavailable on this platform")
+    def test_concurrent_savers_in_different_processes_should_not_lose_changes(self):
+        workers = [
+            multiprocessing.Process(
+                target=_save_tokens_with_merge, args=(self.path, n, 5))
+            for n in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([0] * 4, [worker.exitcode for worker in workers])
+        self.assertEqual(20, len(self._home_account_ids()))
+
+    def test_unversioned_cache_should_be_rejected(self):
+        with self.assertRaises(ValueError):
+            save_with_merge(SerializableTokenCache(), self.path)
+
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+
+from msal.token_cache import TokenCache
+from msal.sqlite_token_cache import SqliteTokenCache
+from tests import unittest
+from tests.test_token_cache import add_token, build_id_token
+
+
+class SqliteTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "token_cache.sqlite")
+        self.cache = SqliteTokenCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _add(self, cache, uid="uid", scope=("s1", "s2"), **kwargs):
+        add_token(
+            cache, uid, scope=scope,
+            access_token="AT for " + uid, refresh_token="RT for " + uid,
+            id_token=build_id_token(
+                oid=uid, aud="my_client_id", exp=4102444800, iat=1000),
+            **kwargs)
+
+    def test_find_should_match_the_in_memory_cache(self):
+        reference = TokenCache()
+        for cache in (self.cache, reference):
+            self._add(cache, uid="alice")
+            self._add(cache, uid="bob", scope=["s3"])
+        for credential_type in (
+                TokenCache.CredentialType.ACCESS_TOKEN,
+                TokenCache.CredentialType.REFRESH_TOKEN,
+                TokenCache.CredentialType.ID_TOKEN,
+                TokenCache.CredentialType.ACCOUNT,
+                TokenCache.CredentialType.APP_METADATA,
+                ):
+            for target, query in [
+                    (None, None),
+                    (["s1"], None),
+                    (["s3"], {"environment": "login.example.com"}),
+                    (None, {"home_account_id": "alice.utid"}),
+                    (None, {"home_account_id": None}),
+                    (None, {"client_id": "my_client_id", "realm": "contoso"}),
+                    ]:
+                self.assertEqual(
+                    reference.find(credential_type, target=target, query=query),
+                    self.cache.find(credential_type, target=target, query=query))
+        self.assertEqual(
+            "4600",
+            self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN, query={
+                "home_account_id": "alice.utid"})[0]["expires_on"])
+
+    def test_modify_and_remove(self):
+        self._add(self.cache)
+        rt = self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN)[0]
+        self.cache.update_rt(rt, "new RT")
+        self.assertEqual(
+            ["new RT"], [e["secret"] for e in self.cache.find(
+                TokenCache.CredentialType.REFRESH_TOKEN)])
+        self.cache.remove_rt(
+            self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN)[0])
+        self.assertEqual(
+            [], self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN))
+        self.assertEqual(
+            1, len(self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN)))
+
+    def test_entries_should_be_shared_by_another_instance(self):
+        self._add(self.cache, uid="alice")
+        another = SqliteTokenCache(self.path)
+        self.assertEqual(
+            ["AT for alice"], [e["secret"] for e in another.find(
+                TokenCache.CredentialType.ACCESS_TOKEN)])
+        self._add(another, uid="bob")
+        self.assertEqual(
+            2, len(self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN)))
+
+    def test_a_failed_add_should_save_nothing(self):
+        class BrokenCache(SqliteTokenCache):
+            def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+                super(BrokenCache, self).modify(
+                    credential_type, old_entry, new_key_value_pairs)
+                if credential_type == self.CredentialType.REFRESH_TOKEN:
+                    raise IOError("Simulate a failure in the middle of add()")
+        with self.assertRaises(IOError):
+            self._add(BrokenCache(self.path))
+        self.assertEqual(
+            [], self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN))
+
+    def test_compact_should_remove_expired_access_tokens_and_orphans(self):
+        self._add(self.cache, uid="alice", ext_expires_in=7200)
+        self._add(self.cache, uid="bob")
+        for rt in self.cache.find(
+                TokenCache.CredentialType.REFRESH_TOKEN,
+                query={"home_account_id": "bob.utid"}):
+            self.cache.remove_rt(rt)
+        self.assertEqual(0, self.cache.compact(now=1500), "Bob still has an AT")
+        self.assertEqual(
+            3,  # Bob's AT, and then his ID token and account
+            self.cache.compact(now=5000))
+        self.assertEqual(
+            ["alice.utid"],
+            [e["home_account_id"] for e in self.cache.find(
+                TokenCache.CredentialType.ACCOUNT)])
+        self.assertEqual(
+            ["AT for alice"], [e["secret"] for e in self.cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN)],
+            "An AT in its extended lifetime shall remain")
+        self.assertEqual(1, SqliteTokenCache(self.path).compact(now=9000),
+            "Expired ATs shall also be found by another instance")
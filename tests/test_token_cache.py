@@ -1,7 +1,11 @@
 import logging
 import base64
 import json
+import mmap
+import tempfile
+import threading
 import time
+import zlib
 
 from msal.token_cache import *
 from tests import unittest
@@ -47,6 +51,19 @@ def build_response(  # simulate a response from AAD
     return response
 
 
+def add_token(  # Mimic a token response from AAD, and add it into cache
+        cache, uid=None, utid="utid", client_id="my_client_id", scope=("s1",),
+        realm="contoso", now=1000,  # A fixed now makes expires_on predictable
+        **kwargs  # Pass-through to build_response(): access_token, refresh_token, ...
+        ):
+    cache.add({
+        "client_id": client_id,
+        "scope": list(scope),
+        "token_endpoint": "https://login.example.com/%s/v2/token" % realm,
+        "response": build_response(uid=uid, utid=utid, **kwargs),
+        }, now=now)
+
+
 class TokenCacheTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -252,6 +269,597 @@ class TokenCacheTestCase(unittest.TestCase):
                 'uid.utid-login.example.com-refreshtoken-my_client_id--s2 s1 s3')
             )
 
+    def _add_at(self, uid, **kwargs):
+        add_token(self.cache, uid, access_token="AT for %s" % uid, **kwargs)
+
+    def test_find_should_use_indexes_and_honor_the_rest_of_query(self):
+        for i in range(100):
+            self._add_at("uid%d" % i)
+        self._add_at("uid42", client_id="another_client_id")
+        self._add_at("uid42", realm="fabrikam")
+        matches = self.cache.find(
+            self.cache.CredentialType.ACCESS_TOKEN, target=["s1"], query={
+                "home_account_id": "uid42.utid",
+                "client_id": "my_client_id",
+                "realm": "contoso",
+                "secret": "AT for uid42",  # An unindexed field
+                })
+        self.assertEqual(1, len(matches))
+        self.assertEqual("AT for uid42", matches[0]["secret"])
+        self.assertEqual([], self.cache.find(
+            self.cache.CredentialType.ACCESS_TOKEN, query={
+                "home_account_id": "uid42.utid", "secret": "wrong"}))
+        self.assertEqual(
+            ["contoso", "fabrikam"],
+            [at["realm"] for at in self.cache.find(
+                self.cache.CredentialType.ACCESS_TOKEN, query={
+                    "home_account_id": "uid42.utid", "client_id": "my_client_id"})],
+            "Matches should be returned in their insertion order")
+
+    def test_find_should_match_entries_whose_target_contains_all_scopes(self):
+        self._add_at("uid1", scope=["s2", "s1", "s3"])
+        self._add_at("uid1", scope=["s1", "s4"])
+        def targets_found_by(target):
+            return [at["target"] for at in self.cache.find(
+                self.cache.CredentialType.ACCESS_TOKEN, target=target)]
+        self.assertEqual(["s2 s1 s3", "s1 s4"], targets_found_by(["s1"]))
+        self.assertEqual(["s2 s1 s3"], targets_found_by(["s3", "s2"]))
+        self.assertEqual(["s1 s4"], targets_found_by(["s4"]))
+        self.assertEqual([], targets_found_by(["s2", "s4"]))
+        self.assertEqual([], targets_found_by(["unknown_scope"]))
+
+    def test_find_should_reflect_removal_and_direct_cache_manipulation(self):
+        self._add_at("uid1")
+        at = self.cache.find(
+            self.cache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "uid1.utid"})[0]
+        self.cache.remove_at(at)
+        self.assertEqual([], self.cache.find(
+            self.cache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "uid1.utid"}))
+        self.cache._cache["AccessToken"]["wrong-key"] = at  # Bypassing modify()
+        self.assertEqual([at], self.cache.find(
+            self.cache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "uid1.utid"}))
+
+    def test_add_many_should_be_equivalent_to_adding_one_by_one(self):
+        def events():
+            for uid in ("uid1", "uid2", "uid1"):  # A repeated user
+                yield {
+                    "client_id": "my_client_id",
+                    "scope": ["s1"],
+                    "token_endpoint": "https://login.example.com/contoso/v2/token",
+                    "data": {"refresh_token": "an old RT"},
+                    "response": build_response(
+                        uid=uid, utid="utid", access_token="AT for %s" % uid,
+                        refresh_token="RT for %s" % uid),
+                    }
+        reference = TokenCache()
+        for event in events():
+            reference.add(event, now=1000)
+        batch = list(events())
+        self.cache.add_many(batch, now=1000)
+        for credential_type in (
+                TokenCache.CredentialType.ACCESS_TOKEN,
+                TokenCache.CredentialType.REFRESH_TOKEN,
+                TokenCache.CredentialType.ACCOUNT,
+                TokenCache.CredentialType.APP_METADATA):
+            self.assertEqual(
+                reference.find(credential_type),
+                self.cache.find(credential_type, query={
+                    "environment": "login.example.com"}))
+        self.assertEqual("********", batch[0]["data"]["refresh_token"])
+        self.assertEqual("********", batch[0]["response"]["refresh_token"])
+
+    def test_add_many_should_save_nothing_when_an_event_is_invalid(self):
+        valid = {
+            "client_id": "my_client_id",
+            "scope": ["s1"],
+            "token_endpoint": "https://login.example.com/contoso/v2/token",
+            "response": build_response(access_token="an AT"),
+            }
+        invalid = dict(valid, response=build_response(
+            access_token="another AT",
+            id_token=build_id_token(aud="another_client_id")))
+        before = self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN)
+        with self.assertRaises(RuntimeError):
+            self.cache.add_many([valid, invalid])
+        self.assertEqual(
+            before, self.cache.find(TokenCache.CredentialType.ACCESS_TOKEN))
+
+
+class TokenCacheWithConcurrentReadsTestCase(TokenCacheTestCase):
+    # Run all inherited test methods against a cache allowing concurrent reads
+
+    def setUp(self):
+        self.cache = TokenCache(concurrent_reads=True)
+
+    def _find_secrets(self):
+        return [at["secret"] for at in self.cache.find(
+            TokenCache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "alice.utid"})]
+
+    def test_lookup_should_not_wait_for_a_write_in_progress(self):
+        add_token(self.cache, "alice", access_token="old AT")
+        self.assertEqual(["old AT"], self._find_secrets())
+        writing, finish = threading.Event(), threading.Event()
+        def slow_subscriber(event):  # It runs while the write holds the lock
+            writing.set()
+            finish.wait()
+        self.cache.subscribe(slow_subscriber)
+        writer = threading.Thread(target=add_token, args=(self.cache, "alice"),
+            kwargs={"access_token": "new AT", "now": 2000})
+        writer.start()
+        writing.wait()
+        found = []
+        reader = threading.Thread(target=lambda: found.append(self._find_secrets()))
+        reader.start()
+        reader.join(5)  # It would time out if the look-up waited for the write
+        finish.set()
+        writer.join()
+        reader.join()
+        self.assertEqual([["old AT"]], found, "Readers see the last published state")
+        self.assertEqual(["new AT"], self._find_secrets())
+
+    def test_a_write_should_see_its_own_changes(self):
+        add_token(
+            self.cache, "alice", access_token="an AT", expires_in=100,
+            id_token=build_id_token())
+        self.assertEqual(["an AT"], self._find_secrets())  # Published
+        self.cache.compact(now=5000)  # It looks up the user of the removed AT
+        self.assertEqual([], self._find_secrets())
+        self.assertEqual(
+            [], self.cache.find(TokenCache.CredentialType.ACCOUNT),
+            "The user has no token left, so compact() shall remove the account")
+
+
+class BoundedTokenCacheTestCase(unittest.TestCase):
+
+    def _add_at(self, cache, uid, now=None, **kwargs):
+        add_token(cache, uid, access_token="AT of %s" % uid, now=now, **kwargs)
+
+    def _secrets(self, cache, credential_type=TokenCache.CredentialType.ACCESS_TOKEN):
+        return sorted(entry["secret"] for entry in cache.find(credential_type))
+
+    def test_least_recently_used_at_should_be_evicted(self):
+        cache = TokenCache(capacity=3)
+        for uid in ("a", "b", "c"):
+            self._add_at(cache, uid)
+        cache.find(  # Using "a" makes "b" the least recently used one
+            TokenCache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "a.utid"})
+        self._add_at(cache, "d")
+        self.assertEqual(["AT of a", "AT of c", "AT of d"], self._secrets(cache))
+        self.assertEqual(
+            {"expired": 0, "least_recently_used": 1},
+            cache.eviction_counts[TokenCache.CredentialType.ACCESS_TOKEN])
+
+    def test_expired_at_should_be_evicted_before_least_recently_used_one(self):
+        cache = TokenCache(capacity=3)
+        self._add_at(cache, "a")
+        self._add_at(cache, "b", now=time.time() - 100, expires_in=10)
+        self._add_at(cache, "c")
+        self._add_at(cache, "d")
+        self.assertEqual(["AT of a", "AT of c", "AT of d"], self._secrets(cache))
+        self.assertEqual(
+            {"expired": 1, "least_recently_used": 0},
+            cache.eviction_counts[TokenCache.CredentialType.ACCESS_TOKEN])
+
+    def test_at_in_its_extended_lifetime_should_not_be_evicted_as_expired(self):
+        cache = TokenCache(capacity=2)
+        self._add_at(cache, "a")
+        self._add_at(
+            cache, "b", now=time.time() - 100, expires_in=10, ext_expires_in=3600)
+        cache.find(  # Using "a" makes "b" the least recently used one anyway
+            TokenCache.CredentialType.ACCESS_TOKEN,
+            query={"home_account_id": "a.utid"})
+        self._add_at(cache, "c")
+        self.assertEqual(
+            {"expired": 0, "least_recently_used": 1},
+            cache.eviction_counts[TokenCache.CredentialType.ACCESS_TOKEN])
+
+    def test_concurrent_lookups_should_keep_recency_consistent(self):
+        cache = TokenCache(capacity=20)
+        for i in range(20):
+            self._add_at(cache, "uid%d" % i)
+        def look_up(n):
+            for i in range(200):
+                cache.find(TokenCache.CredentialType.ACCESS_TOKEN, query={
+                    "home_account_id": "uid%d.utid" % ((n + i) % 20)})
+        threads = [threading.Thread(target=look_up, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(
+            set(cache._cache[TokenCache.CredentialType.ACCESS_TOKEN]),
+            set(cache._recency[TokenCache.CredentialType.ACCESS_TOKEN]))
+
+    def test_capacity_can_be_specified_per_credential_type(self):
+        cache = TokenCache(capacity={TokenCache.CredentialType.REFRESH_TOKEN: 1})
+        self._add_at(cache, "a", refresh_token="RT of a")
+        self._add_at(cache, "b", refresh_token="RT of b")
+        self.assertEqual(["AT of a", "AT of b"], self._secrets(cache))
+        self.assertEqual(["RT of b"], self._secrets(
+            cache, TokenCache.CredentialType.REFRESH_TOKEN))
+
+    def test_eviction_should_be_serialized(self):
+        cache = SerializableTokenCache(capacity=1)
+        cache.deserialize(json.dumps({"AccessToken": {}}, indent=4), lazy=True)
+        self._add_at(cache, "a")
+        cache.serialize_delta()
+        self._add_at(cache, "b")
+        self.assertIn(None, json.loads(
+            cache.serialize_delta())["AccessToken"].values())
+        self.assertEqual(
+            ["AT of b"],
+            [at["secret"] for at in json.loads(
+                cache.serialize())["AccessToken"].values()])
+
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache()
+
+    def _add(self, uid, **kwargs):
+        add_token(
+            self.cache, uid, access_token="AT of %s" % uid,
+            id_token=build_id_token(aud="my_client_id"), **kwargs)
+
+    def _count(self, credential_type):
+        return len(self.cache.find(credential_type))
+
+    def test_compact_should_remove_expired_access_tokens_only(self):
+        self._add("a", expires_in=100, refresh_token="RT of a")
+        self._add("b", expires_in=200, refresh_token="RT of b")
+        self.assertEqual(1, self.cache.compact(now=1150))
+        self.assertEqual(
+            ["AT of b"],
+            [at["secret"] for at in self.cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN)])
+        self.assertEqual(0, self.cache.compact(now=1150))
+
+    def test_compact_should_keep_access_tokens_in_their_extended_lifetime(self):
+        self._add("a", expires_in=100, ext_expires_in=7200)
+        self.assertEqual(0, self.cache.compact(now=1150))
+        self.assertEqual(1, self._count(TokenCache.CredentialType.ACCESS_TOKEN))
+        self.cache.compact(now=8300)
+        self.assertEqual(0, self._count(TokenCache.CredentialType.ACCESS_TOKEN))
+
+    def test_compact_should_remove_orphans(self):
+        self._add("a", refresh_token="RT of a")
+        self._add("b", refresh_token="RT of b")
+        for rt in self.cache.find(
+                TokenCache.CredentialType.REFRESH_TOKEN,
+                query={"home_account_id": "a.utid"}):
+            self.cache.remove_rt(rt)
+        self.cache.compact(now=5000)  # All ATs expired by then
+        self.assertEqual(1, self._count(TokenCache.CredentialType.REFRESH_TOKEN))
+        for credential_type in (
+                TokenCache.CredentialType.ID_TOKEN,
+                TokenCache.CredentialType.ACCOUNT):
+            self.assertEqual(
+                ["b.utid"],
+                [entry["home_account_id"]
+                    for entry in self.cache.find(credential_type)],
+                "The user still having an RT shall remain")
+        self.assertEqual(1, self._count(TokenCache.CredentialType.APP_METADATA))
+
+        for rt in self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN):
+            self.cache.remove_rt(rt)
+        self.cache.compact(now=5000)
+        for credential_type in (
+                TokenCache.CredentialType.ID_TOKEN,
+                TokenCache.CredentialType.ACCOUNT,
+                TokenCache.CredentialType.APP_METADATA):
+            self.assertEqual(0, self._count(credential_type))
+
+    def test_compact_should_not_update_recency(self):
+        self.cache = TokenCache(
+            capacity={TokenCache.CredentialType.ACCESS_TOKEN: 2})
+        self._add("a", refresh_token="RT of a")
+        add_token(  # Of another app, so the app metadata check won't see it
+            self.cache, "b", client_id="another_client_id", access_token="AT of b")
+        for rt in self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN):
+            self.cache.remove_rt(rt)
+        self.cache.compact(now=1500)  # It would look for the AT of "a"
+        self._add("c")
+        self.assertEqual(
+            ["AT of b", "AT of c"],
+            sorted(at["secret"] for at in self.cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN)),
+            "The least recently used AT shall still be that of a")
+
+    def test_compaction_could_be_run_periodically_during_writes(self):
+        self.cache = TokenCache(compact_interval=0.001)
+        self._add("a", now=time.time() - 100, expires_in=10)
+        time.sleep(0.01)
+        self._add("b", now=time.time())
+        self.assertEqual(
+            ["AT of b"],
+            [at["secret"] for at in self.cache.find(
+                TokenCache.CredentialType.ACCESS_TOKEN)])
+
+    def test_compaction_of_a_lazily_deserialized_cache(self):
+        self.cache = SerializableTokenCache()
+        self._add("a", expires_in=100, refresh_token="RT of a")
+        state = self.cache.serialize()
+        self.cache.deserialize(state, lazy=True)
+        self.assertEqual(1, self.cache.compact(now=2000))
+        self.assertTrue(self.cache.has_state_changed)
+        self.assertEqual(
+            {}, json.loads(self.cache.serialize())["AccessToken"])
+
+
+class VersionedTokenCacheTestCase(unittest.TestCase):
+
+    def _add(self, cache, uid, refresh_token="an RT", now=1000):
+        add_token(cache, uid, refresh_token=refresh_token, now=now)
+
+    def _rt_secrets(self, cache):
+        return sorted(rt["secret"] for rt in cache.find(
+            TokenCache.CredentialType.REFRESH_TOKEN))
+
+    def test_version_should_only_be_bumped_by_changes(self):
+        cache = SerializableTokenCache(versioned=True)
+        self._add(cache, "alice")
+        state = cache.serialize()
+        self.assertEqual(1, json.loads(state)[cache.VERSION_KEY])
+        self.assertEqual(1, cache.get_version(state))
+        self.assertEqual(1, cache.get_version(cache.serialize()), "No change")
+        self._add(cache, "bob")
+        self.assertEqual(2, cache.get_version(cache.serialize()))
+        another = SerializableTokenCache()
+        another.deserialize(cache.serialize())
+        self.assertEqual(2, another.version)
+        self.assertNotIn(
+            SerializableTokenCache.VERSION_KEY,
+            json.loads(SerializableTokenCache().serialize()),
+            "Unversioned state shall remain the same as before")
+
+    def test_merge_should_keep_both_sides_changes_and_the_newer_entry(self):
+        ours = SerializableTokenCache(versioned=True)
+        self._add(ours, "alice")
+        base = ours.serialize()
+        theirs = SerializableTokenCache(versioned=True)
+        theirs.deserialize(base)
+        rt = theirs.find(TokenCache.CredentialType.REFRESH_TOKEN)[0]
+        theirs.modify(TokenCache.CredentialType.REFRESH_TOKEN, rt, {
+            "secret": "RT rotated by them", "last_modification_time": "3000"})
+        ours.modify(TokenCache.CredentialType.REFRESH_TOKEN, rt, {
+            "secret": "RT rotated by us earlier", "last_modification_time": "2000"})
+        self._add(ours, "bob", refresh_token="RT of bob")
+
+        ours.merge(theirs.serialize())
+        self.assertEqual(["RT of bob", "RT rotated by them"], self._rt_secrets(ours))
+        self.assertEqual(2, ours.version)
+        self.assertTrue(ours.has_state_changed, "Our change is not saved yet")
+        self.assertEqual(3, ours.get_version(ours.serialize()))
+
+    def test_merge_should_not_remove_an_entry_newer_than_the_one_we_removed(self):
+        ours = SerializableTokenCache(versioned=True)
+        self._add(ours, "alice")
+        self._add(ours, "bob")
+        base = ours.serialize()
+        theirs = SerializableTokenCache(versioned=True)
+        theirs.deserialize(base)
+        rt = theirs.find(
+            TokenCache.CredentialType.REFRESH_TOKEN,
+            query={"home_account_id": "alice.utid"})[0]
+        theirs.modify(TokenCache.CredentialType.REFRESH_TOKEN, rt, {
+            "secret": "RT rotated by them", "last_modification_time": "3000"})
+        for rt in ours.find(TokenCache.CredentialType.REFRESH_TOKEN):
+            ours.remove_rt(rt)
+
+        ours.merge(theirs.serialize())
+        self.assertEqual(["RT rotated by them"], self._rt_secrets(ours),
+            "Bob's RT shall be removed, but not the newer RT of Alice")
+        ours.merge(theirs.serialize())  # The removal shall still be tracked
+        self.assertEqual(["RT rotated by them"], self._rt_secrets(ours))
+
+
+class PartitionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SerializableTokenCache()
+        for uid in ("alice", "bob", "carol"):
+            self._add(self.cache, uid)
+
+    def _add(self, cache, uid, refresh_token=None, now=1000):
+        add_token(
+            cache, uid, access_token="AT of %s" % uid,
+            refresh_token=refresh_token or "RT of %s" % uid,
+            id_token=build_id_token(aud="my_client_id"), now=now)
+
+    def test_serialize_partition_should_only_contain_one_user(self):
+        self.cache.serialize()
+        partition = json.loads(self.cache.serialize_partition("bob.utid"))
+        for credential_type in ("AccessToken", "RefreshToken", "IdToken", "Account"):
+            self.assertEqual(
+                ["bob.utid"],
+                [e["home_account_id"] for e in partition[credential_type].values()])
+        self.assertEqual(1, len(partition["AppMetadata"]))
+        self.assertFalse(self.cache.has_state_changed, "It is not a checkpoint")
+        self.assertEqual(
+            partition,
+            json.loads(zlib.decompress(self.cache.serialize_partition(
+                "bob.utid", format=SerializableTokenCache.Format.ZLIB))))
+
+    def test_partition_can_be_merged_into_another_cache(self):
+        session = self.cache.serialize_partition("bob.utid")
+        web_request_cache = SerializableTokenCache()
+        web_request_cache.deserialize(session)
+        self.assertEqual(1, len(web_request_cache.find(
+            TokenCache.CredentialType.ACCESS_TOKEN)))
+
+        self._add(web_request_cache, "bob", refresh_token="RT rotated", now=2000)
+        self.cache.merge_partition(web_request_cache.serialize_partition("bob.utid"))
+        self.assertEqual(
+            ["RT of alice", "RT of carol", "RT rotated"],
+            sorted(rt["secret"] for rt in self.cache.find(
+                TokenCache.CredentialType.REFRESH_TOKEN)))
+        self.assertTrue(self.cache.has_state_changed)
+
+        self.cache.merge_partition(session)  # An outdated partition
+        self.assertEqual(["RT rotated"], [rt["secret"] for rt in self.cache.find(
+            TokenCache.CredentialType.REFRESH_TOKEN,
+            query={"home_account_id": "bob.utid"})])
+
+
+class SubscriptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache()
+        self.events = []
+
+    def _add(self, uid="uid", refresh_token="an RT"):
+        add_token(self.cache, uid, refresh_token=refresh_token)
+
+    def _find_rt(self):
+        return self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN)[0]
+
+    def test_synchronous_subscriber_should_receive_real_changes(self):
+        self.cache.subscribe(self.events.append)
+        self._add()
+        self.assertEqual(
+            [TokenCache.CredentialType.ACCOUNT,
+                TokenCache.CredentialType.REFRESH_TOKEN,
+                TokenCache.CredentialType.APP_METADATA],
+            [e["credential_type"] for e in self.events])
+        self.assertTrue(all(e["old"] is None for e in self.events))
+        del self.events[:]
+        self._add()  # An identical rewrite
+        self.assertEqual([], self.events)
+        rt = self._find_rt()
+        self.cache.remove_rt(rt)
+        self.assertEqual([{
+            "credential_type": TokenCache.CredentialType.REFRESH_TOKEN,
+            "key": self.cache.key_makers[
+                TokenCache.CredentialType.REFRESH_TOKEN](**rt),
+            "old": rt,
+            "new": None,
+            "removed": True,
+            }], self.events)
+        self.cache.unsubscribe(self.events.append)
+        self._add()
+        self.assertEqual(1, len(self.events))
+
+    def test_asynchronous_subscriber_should_receive_events_in_order(self):
+        self.cache.subscribe(self.events.append, asynchronous=True)
+        self._add()
+        for i in (1, 2):
+            self.cache.update_rt(self._find_rt(), "RT %d" % i)
+        self.cache.unsubscribe(self.events.append)  # It waits for the delivery
+        self.assertEqual(
+            ["an RT", "RT 1", "RT 2"],
+            [e["new"]["secret"] for e in self.events
+                if e["credential_type"] == TokenCache.CredentialType.REFRESH_TOKEN])
+
+    def test_coalesced_events_should_merge_changes_of_one_key(self):
+        self._add()
+        original_rt = self._find_rt()
+        busy, release = threading.Event(), threading.Event()
+        def slow_subscriber(event):
+            busy.set()
+            release.wait()  # Meanwhile, later events would be coalesced
+            self.events.append(event)
+        self.cache.subscribe(slow_subscriber, asynchronous=True, coalesce=True)
+        self._add(uid="another")  # Keeps the subscriber busy
+        busy.wait()
+        for i in range(3):
+            self.cache.update_rt(self._find_rt(), "RT %d" % i)
+        release.set()
+        self.cache.unsubscribe(slow_subscriber)
+        rt_events = [e for e in self.events
+            if e["credential_type"] == TokenCache.CredentialType.REFRESH_TOKEN
+            and e["old"] is not None]
+        self.assertEqual(1, len(rt_events))
+        self.assertEqual(original_rt, rt_events[0]["old"])
+        self.assertEqual("RT 2", rt_events[0]["new"]["secret"])
+
+    def test_coalesce_requires_asynchronous_delivery(self):
+        with self.assertRaises(ValueError):
+            self.cache.subscribe(self.events.append, coalesce=True)
+
+    def test_a_failing_subscriber_should_not_break_the_cache(self):
+        def broken_subscriber(event):
+            raise RuntimeError("Simulate a subscriber failure")
+        self.cache.subscribe(broken_subscriber)
+        self._add()
+        self.assertEqual("an RT", self._find_rt()["secret"])
+
+    def test_subscription_should_cover_all_shards(self):
+        self.cache = ShardedTokenCache()
+        self.cache.subscribe(self.events.append)
+        self._add(uid="alice")
+        self._add(uid="bob")
+        self.assertEqual(
+            set(["alice.utid", "bob.utid"]),
+            set(e["new"]["home_account_id"] for e in self.events
+                if e["credential_type"] == TokenCache.CredentialType.REFRESH_TOKEN))
+
+
+class ShardedTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ShardedTokenCache()
+        for uid in ("alice", "bob"):
+            add_token(
+                self.cache, uid, access_token="AT of %s" % uid,
+                refresh_token="RT of %s" % uid)
+        add_token(self.cache, access_token="AT of app")  # An app-only token
+
+    def test_entries_should_be_partitioned_by_user_and_by_realm(self):
+        self.assertEqual(
+            set([
+                ("home_account_id", "alice.utid"),
+                ("home_account_id", "bob.utid"),
+                ("realm", "contoso"),  # App-only token
+                ("realm", None),  # App metadata
+                ]),
+            set(self.cache._shards))
+        self.assertEqual(
+            ["AT of alice"],
+            [at["secret"] for at in self.cache._shards[
+                ("home_account_id", "alice.utid")].find(
+                    TokenCache.CredentialType.ACCESS_TOKEN)])
+
+    def test_find_should_route_to_one_shard_or_visit_all_shards(self):
+        AT = TokenCache.CredentialType.ACCESS_TOKEN
+        self.assertEqual(["AT of bob"], [at["secret"] for at in self.cache.find(
+            AT, target=["s1"], query={"home_account_id": "bob.utid"})])
+        self.assertEqual(["AT of app"], [at["secret"] for at in self.cache.find(
+            AT, query={"home_account_id": None, "realm": "contoso"})])
+        self.assertEqual(
+            ["AT of alice", "AT of app", "AT of bob"],
+            sorted(at["secret"] for at in self.cache.find(
+                AT, query={"environment": "login.example.com"})))
+        self.assertEqual(1, len(self.cache.find(
+            TokenCache.CredentialType.APP_METADATA,
+            query={"client_id": "my_client_id"})))
+
+    def test_compact_should_remove_app_metadata_orphaned_in_other_shards(self):
+        for rt in self.cache.find(TokenCache.CredentialType.REFRESH_TOKEN):
+            self.cache.remove_rt(rt)
+        self.assertEqual(
+            6,  # 3 ATs, then 2 accounts, and then the app metadata
+            self.cache.compact(now=1500 + 3600))
+        self.assertEqual([], self.cache.find(
+            TokenCache.CredentialType.APP_METADATA))
+
+    def test_removal_should_only_affect_one_shard(self):
+        RT = TokenCache.CredentialType.REFRESH_TOKEN
+        for rt in self.cache.find(RT, query={"home_account_id": "alice.utid"}):
+            self.cache.remove_rt(rt)
+        self.assertEqual([], self.cache.find(
+            RT, query={"home_account_id": "alice.utid"}))
+        self.assertEqual(["RT of bob"], [rt["secret"] for rt in self.cache.find(
+            RT, query={"home_account_id": "bob.utid"})])
+        self.cache.remove_rt({  # Removing a non-existent entry is a no-op
+            "credential_type": RT, "home_account_id": "nobody.utid"})
+        self.assertNotIn(("home_account_id", "nobody.utid"), self.cache._shards)
+
 
 class SerializableTokenCacheTestCase(TokenCacheTestCase):
     # Run all inherited test methods, and have extra check in tearDown()
@@ -274,6 +882,110 @@ class SerializableTokenCacheTestCase(TokenCacheTestCase):
         self.assertFalse(cache.has_state_changed)
         cache.add({})  # An NO-OP add() still counts as a state change. Good enough.
         self.assertTrue(cache.has_state_changed)
+        cache.serialize()
+        cache.add_many([])
+        self.assertFalse(cache.has_state_changed)
+
+    def test_identical_rewrites_should_not_change_state(self):
+        add_token(self.cache, "uid", access_token="an AT")
+        self.cache.serialize()
+        add_token(self.cache, "uid", access_token="an AT")
+        self.assertFalse(self.cache.has_state_changed)
+        self.assertEqual(set(), self.cache.changed_credential_types)
+        self.assertEqual("{}", self.cache.serialize_delta())
+        # Account and AppMetadata remain the same
+        add_token(self.cache, "uid", access_token="another AT")
+        self.assertTrue(self.cache.has_state_changed)
+        self.assertEqual(
+            set([TokenCache.CredentialType.ACCESS_TOKEN]),
+            self.cache.changed_credential_types)
+        self.cache.serialize()
+        self.assertEqual(set(), self.cache.changed_credential_types)
+        self.assertFalse(self.cache.remove_rt({  # A no-op removal
+            "credential_type": TokenCache.CredentialType.REFRESH_TOKEN}))
+        self.assertFalse(self.cache.has_state_changed)
+
+    def test_journal_of_deltas_should_be_replayable_onto_a_snapshot(self):
+        snapshot = self.cache.serialize()
+        add_token(self.cache, "uid", access_token="an AT", refresh_token="an RT")
+        journal = [self.cache.serialize_delta()]
+        self.assertFalse(self.cache.has_state_changed)
+        self.assertEqual("{}", self.cache.serialize_delta(), "No change since then")
+        for at in self.cache.find(self.cache.CredentialType.ACCESS_TOKEN):
+            if at.get("secret") == "an AT":
+                self.cache.remove_at(at)
+        journal.append(self.cache.serialize_delta())
+        self.assertEqual(
+            {"AccessToken": {
+                "uid.utid-login.example.com-accesstoken-my_client_id-contoso-s1":
+                None}},
+            json.loads(journal[-1]),
+            "A removal should be recorded as null")
+
+        replica = SerializableTokenCache()
+        replica.deserialize(snapshot)
+        replica.apply_delta("\n".join(journal) + "\n")
+        self.assertFalse(replica.has_state_changed)
+        self.assertEqual(self.cache._cache, replica._cache)
+        self.assertEqual(1, len(replica.find(
+            replica.CredentialType.REFRESH_TOKEN,
+            query={"home_account_id": "uid.utid"})),
+            "Replayed entries should be searchable")
+
+    def test_compact_formats_should_be_smaller_and_auto_detected(self):
+        add_token(self.cache, "uid", access_token="an AT", refresh_token="an RT")
+        pretty = self.cache.serialize()
+        compact = self.cache.serialize(format=SerializableTokenCache.Format.COMPACT_JSON)
+        compressed = self.cache.serialize(format=SerializableTokenCache.Format.ZLIB)
+        self.assertEqual(json.loads(pretty), json.loads(compact))
+        self.assertLess(len(compact), len(pretty))
+        self.assertIsInstance(compressed, bytes)
+        self.assertLess(len(compressed), len(compact))
+        for state in (pretty, compact, compressed, compact.encode("utf-8")):
+            replica = SerializableTokenCache()
+            replica.deserialize(state)
+            self.assertEqual(self.cache._cache, replica._cache)
+        with self.assertRaises(ValueError):
+            self.cache.serialize(format="unknown")
+
+    def test_json_codec_should_be_pluggable(self):
+        class Codec(object):  # Mimic a codec whose dumps() returns bytes
+            calls = []
+            def dumps(self, obj):
+                self.calls.append("dumps")
+                return json.dumps(obj).encode("utf-8")
+            def loads(self, s):
+                self.calls.append("loads")
+                return json.loads(s)
+        cache = SerializableTokenCache(json_codec=Codec())
+        cache.deserialize('{"AccessToken": {}}')
+        state = cache.serialize(format=SerializableTokenCache.Format.COMPACT_JSON)
+        self.assertEqual('{"AccessToken": {}}', state)
+        self.assertEqual(["loads", "dumps"], Codec.calls)
+
+    def test_lazy_deserialization_should_only_load_types_being_used(self):
+        add_token(self.cache, "uid", access_token="an AT", refresh_token="an RT")
+        state = self.cache.serialize()
+        with tempfile.TemporaryFile() as f:
+            f.write(state.encode("utf-8"))
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for s in (state, state.encode("utf-8"), mapped):
+                replica = SerializableTokenCache()
+                replica.deserialize(s, lazy=True)
+                self.assertEqual({}, replica._cache, "Nothing is parsed yet")
+                self.assertEqual(["an RT"], [rt["secret"] for rt in replica.find(
+                    replica.CredentialType.REFRESH_TOKEN,
+                    query={"home_account_id": "uid.utid"})])
+                self.assertEqual(["RefreshToken"], list(replica._cache))
+                self.assertEqual(json.loads(state), json.loads(replica.serialize()))
+            mapped.close()
+
+    def test_lazy_deserialization_should_fall_back_to_eager_one(self):
+        state = self.cache.serialize(format=SerializableTokenCache.Format.COMPACT_JSON)
+        replica = SerializableTokenCache()
+        replica.deserialize(state, lazy=True)
+        self.assertEqual(json.loads(state), replica._cache)
 
     def tearDown(self):
         state = self.cache.serialize()